@@ -0,0 +1,117 @@
+import argparse
+import contextlib
+import glob
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import cv2
+from colorama import Fore
+
+from src.benchmark import find_images
+from src.cv.chessboard_find import find_chessboard
+
+
+def collect_paths(inputs: list[str]) -> list[Path]:
+    paths = []
+    for item in inputs:
+        if Path(item).is_dir():
+            paths.extend(find_images(Path(item)))
+        else:
+            paths.extend(Path(p) for p in sorted(glob.glob(item, recursive=True)))
+    return list(dict.fromkeys(paths))
+
+
+# every worker process runs one image at a time, so opencv threads would only compete with other workers
+def init_worker() -> None:
+    cv2.setNumThreads(1)
+
+
+# JSON ready result of one image, the pipeline prints the failure reason, so its last line is kept
+def process_image(path: str, is_white_sided: bool, detection_size: int = None, refine_corners: bool = False) -> dict:
+    started_at = time.perf_counter()
+    result = {"path": path, "ok": False}
+
+    output = io.StringIO()
+    try:
+        image = cv2.imread(path)
+        if image is None:
+            result["error"] = "Can't read the image"
+            return result
+        result["shape"] = list(image.shape)
+
+        with contextlib.redirect_stdout(output):
+            chessboard = find_chessboard(
+                image, is_white_sided=is_white_sided, detection_size=detection_size, refine_corners=refine_corners
+            )
+        if chessboard is None:
+            lines = output.getvalue().strip().splitlines()
+            result["error"] = lines[-1] if len(lines) != 0 else "Chessboard isn't found"
+            return result
+
+        # the 8th rank goes first as in FEN, cells are the first letters of the Position names
+        result["ok"] = True
+        result["positions"] = ["".join(p.name[0] for p in row) for row in reversed(chessboard.positions)]
+        return result
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+        return result
+    finally:
+        result["time_ms"] = (time.perf_counter() - started_at) * 1000
+
+
+# results are written as JSON lines in the order the images are done
+def run_batch(
+    paths: list[Path],
+    output,
+    is_white_sided: bool,
+    workers: int = None,
+    detection_size: int = None,
+    refine_corners: bool = False
+) -> tuple[int, int]:
+    done, failed = 0, 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+        futures = [
+            executor.submit(process_image, str(path), is_white_sided, detection_size, refine_corners)
+            for path in paths
+        ]
+        for future in as_completed(futures):
+            result = future.result()
+            output.write(json.dumps(result) + "\n")
+            output.flush()
+            done += 1
+            failed += int(not result["ok"])
+    return done, failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Chessboard positions of stored images, one JSON line per image')
+    parser.add_argument('inputs', nargs='+', help="Image files, directories or glob patterns")
+    parser.add_argument('--output', type=str, default=None, help="JSON lines file, stdout by default")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="Worker processes")
+    parser.add_argument('--white-sided', action='store_true', help="Wrap boards as seen from the white side")
+    parser.add_argument('--detection-size', type=int, default=1280, help="Longest side of the downscaled image copy where the board is searched, 0 to search in full resolution")
+    parser.add_argument('--refine-corners', action='store_true', help="Refine the board corners found on the downscaled image in full resolution")
+    args = parser.parse_args()
+
+    paths = collect_paths(args.inputs)
+    if len(paths) == 0:
+        print(f"{Fore.RED}Exception: No images found{Fore.RESET}", file=sys.stderr)
+        sys.exit(1)
+
+    started_at = time.perf_counter()
+    with open(args.output, 'w') if args.output is not None else contextlib.nullcontext(sys.stdout) as output:
+        done, failed = run_batch(
+            paths,
+            output,
+            args.white_sided,
+            args.workers,
+            args.detection_size if args.detection_size > 0 else None,
+            args.refine_corners
+        )
+    elapsed = time.perf_counter() - started_at
+    print(f"{Fore.GREEN}{done} images in {elapsed:.1f} s, {failed} failed{Fore.RESET}", file=sys.stderr)
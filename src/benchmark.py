@@ -0,0 +1,159 @@
+import argparse
+import contextlib
+import io
+import json
+import time
+from pathlib import Path
+from typing import Final
+
+import cv2
+import numpy as np
+from colorama import Fore
+
+from src import instrumentation
+from src.cv.chessboard_find import find_chessboard
+
+
+# instrumentation spans of find_chessboard
+stages: Final[tuple[str]] = (
+    "cv.downscale",
+    "cv.get_edges",
+    "cv.find_contours",
+    "cv.filter_squares",
+    "cv.cluster_squares",
+    "cv.process_rotation",
+    "cv.create_grid",
+    "cv.expand_grid",
+    "cv.warp",
+    "cv.refine_corners",
+    "cv.build_positions",
+    "cv.find_chessboard",
+)
+
+image_patterns: Final[tuple[str]] = ("*.jpg", "*.jpeg", "*.png")
+# cells crops are not whole boards
+skipped_prefix: Final[str] = "cell_"
+
+
+# returns number of failed runs, stages timings are collected by the instrumentation
+def run_pipeline(image, is_white_sided: bool, runs: int, detection_size: int = None, refine_corners: bool = False) -> int:
+    failures = 0
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(runs):
+            chessboard = find_chessboard(
+                image, is_white_sided=is_white_sided, detection_size=detection_size, refine_corners=refine_corners
+            )
+            if chessboard is None:
+                failures += 1
+    return failures
+
+
+def calc_stats(values: list[float]) -> dict[str, float]:
+    if len(values) == 0:
+        return {"count": 0}
+    ms = np.array(values) * 1000
+    return {
+        "count": len(values),
+        "mean_ms": float(ms.mean()),
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p95_ms": float(np.percentile(ms, 95)),
+    }
+
+
+def find_images(directory: Path) -> list[Path]:
+    paths = set()
+    for pattern in image_patterns:
+        paths.update(directory.glob(pattern))
+    return sorted(p for p in paths if not p.name.startswith(skipped_prefix))
+
+
+# scale upsamples the images to emulate higher resolution cameras
+def run_benchmark(
+    directory: Path,
+    runs: int,
+    warmup: int,
+    is_white_sided: bool,
+    scale: float = 1.0,
+    detection_size: int = None,
+    refine_corners: bool = False
+) -> dict:
+    instrumentation.enable()
+    total_timings = {stage: [] for stage in stages}
+    images_result = {}
+
+    for path in find_images(directory):
+        image = cv2.imread(str(path))
+        if image is None:
+            print(f"{Fore.RED}Exception: Can't read {path}{Fore.RESET}")
+            continue
+        if scale != 1.0:
+            image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_CUBIC)
+
+        run_pipeline(image, is_white_sided, warmup, detection_size, refine_corners)
+        instrumentation.reset()
+        failures = run_pipeline(image, is_white_sided, runs, detection_size, refine_corners)
+        timings = {stage: instrumentation.get_recent_values(stage) for stage in stages}
+
+        for stage in stages:
+            total_timings[stage].extend(timings[stage])
+        images_result[path.name] = {
+            "shape": list(image.shape),
+            "failures": failures,
+            "stages": {stage: calc_stats(timings[stage]) for stage in stages},
+        }
+        total = images_result[path.name]['stages']['cv.find_chessboard'].get('p50_ms', 0)
+        print(f"{path.name}: total p50 {total:.1f} ms, failures {failures}")
+
+    return {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "runs": runs,
+        "scale": scale,
+        "detection_size": detection_size,
+        "opencv": cv2.__version__,
+        "numpy": np.__version__,
+        "images": images_result,
+        "stages": {stage: calc_stats(total_timings[stage]) for stage in stages},
+    }
+
+
+def print_report(result: dict) -> None:
+    print(f"{'stage':<22}{'count':>7}{'mean':>10}{'p50':>10}{'p95':>10}")
+    for stage, stats in result["stages"].items():
+        if stats["count"] == 0:
+            print(f"{stage:<22}{0:>7}")
+            continue
+        print(f"{stage:<22}{stats['count']:>7}{stats['mean_ms']:>10.2f}{stats['p50_ms']:>10.2f}{stats['p95_ms']:>10.2f}")
+
+
+def print_comparison(result: dict, baseline: dict) -> None:
+    print(f"{'stage':<22}{'base p50':>10}{'p50':>10}{'change':>10}")
+    for stage, stats in result["stages"].items():
+        base = baseline["stages"].get(stage, {"count": 0})
+        if stats["count"] == 0 or base["count"] == 0:
+            continue
+        change = (stats["p50_ms"] - base["p50_ms"]) / base["p50_ms"] * 100
+        print(f"{stage:<22}{base['p50_ms']:>10.2f}{stats['p50_ms']:>10.2f}{change:>9.1f}%")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Per-stage latency of the chessboard detection pipeline')
+    parser.add_argument('--data', type=str, default='data', help="Directory with the chessboard images")
+    parser.add_argument('--runs', type=int, default=20, help="Measured runs per image")
+    parser.add_argument('--warmup', type=int, default=2, help="Not measured runs per image")
+    parser.add_argument('--white-sided', action='store_true', help="Wrap boards as seen from the white side")
+    parser.add_argument('--scale', type=float, default=1.0, help="Resize the images by this factor before the runs")
+    parser.add_argument('--detection-size', type=int, default=None, help="Longest side of the image copy where the board is searched")
+    parser.add_argument('--refine-corners', action='store_true', help="Refine the board corners in full resolution")
+    parser.add_argument('--output', type=str, default=None, help="JSON file for the results")
+    parser.add_argument('--compare', type=str, default=None, help="JSON file of a previous run to compare with")
+    args = parser.parse_args()
+
+    result = run_benchmark(
+        Path(args.data), args.runs, args.warmup, args.white_sided, args.scale, args.detection_size, args.refine_corners
+    )
+    print_report(result)
+    if args.compare is not None:
+        print_comparison(result, json.loads(Path(args.compare).read_text()))
+    if args.output is not None:
+        Path(args.output).write_text(json.dumps(result, indent=2))
+        print(f"Results are saved to {args.output}")
@@ -1,7 +1,103 @@
+import json
+import queue
+import threading
+import time
+from pathlib import Path
+from typing import Final
+
 import cv2
+from cv2.typing import MatLike
+
+from src.recording import FrameRecording
+
+
+# seconds to wait for a camera to open
+probe_timeout: Final[float] = 3.0
+# the last selected camera
+camera_cache_path: Final[Path] = Path.home() / ".cache" / "chess-bot" / "camera.json"
+
+
+# cv2.VideoCapture like source of the game frames, the base one has no frames
+class FrameSource:
+    # live sources produce frames on their own, so readers take the newest frame and drop the others
+    is_live: bool = False
+    # time of the last read frame in seconds, None when the source has no time of its own and the reading time is used
+    timestamp: float | None = None
+
+    def read(self) -> tuple[bool, MatLike | None]:
+        return False, None
+
+    def release(self) -> None:
+        pass
+
+
+class CameraSource(FrameSource):
+    is_live = True
+    capture: cv2.VideoCapture
+
+    def __init__(self, capture: cv2.VideoCapture):
+        self.capture = capture
+
+    def read(self) -> tuple[bool, MatLike | None]:
+        return self.capture.read()
+
+    def release(self) -> None:
+        self.capture.release()
 
 
-def select_camera() -> cv2.VideoCapture | None:
+# every frame_step-th frame of the file, skipped frames are grabbed without decoding
+class VideoFileSource(FrameSource):
+    path: str
+    frame_step: int
+
+    def __init__(self, path: str, frame_step: int = 1):
+        self.path = path
+        self.frame_step = frame_step
+        self.capture = cv2.VideoCapture(path)
+
+    def read(self) -> tuple[bool, MatLike | None]:
+        for _ in range(self.frame_step - 1):
+            if not self.capture.grab():
+                return False, None
+        ret, frame = self.capture.read()
+        self.timestamp = self.capture.get(cv2.CAP_PROP_POS_MSEC) / 1000
+        return ret, frame
+
+    def release(self) -> None:
+        self.capture.release()
+
+
+# frames of a FrameRecorder recording from the oldest one, as fast as they are read
+class RecordingSource(FrameSource):
+    recording: FrameRecording
+    # recorded time of the last read frame
+    timestamp: float | None
+    position: int
+
+    def __init__(self, recording: FrameRecording):
+        self.recording = recording
+        self.timestamp = None
+        self.position = 0
+
+    def read(self) -> tuple[bool, MatLike | None]:
+        if self.position >= len(self.recording):
+            return False, None
+        self.timestamp, frame = self.recording.get_frame(self.position)
+        self.position += 1
+        return True, frame
+
+    # position is the index of the next read frame from the oldest one
+    def seek(self, position: int) -> None:
+        self.position = min(max(position, 0), len(self.recording))
+
+
+# the camera is opened without asking when it's still available
+def select_camera(use_cache: bool = True) -> CameraSource | None:
+    if use_cache:
+        cap = __open_cached_camera()
+        if cap is not None:
+            return CameraSource(cap)
+
     cameras = list_cameras()
     
     if len(cameras) == 0:
@@ -10,7 +106,7 @@ def select_camera() -> cv2.VideoCapture | None:
     
     print("Available cameras:")
     for cam in cameras:
-        print(f"- Cam {cam[1]}")
+        print(f"- Cam {cam[0]} ({cam[1]})")
 
     cap = None
     while cap is None:
@@ -19,24 +115,101 @@ def select_camera() -> cv2.VideoCapture | None:
             for cam in cameras:
                 if cam[0] != selection:
                     continue
-                cap = cv2.VideoCapture(selection)
-            print("Exception: can't find this camera")
+                cap = cv2.VideoCapture(selection, __get_backend_id(cam[1]))
+                backend = cam[1]
+            if cap is None:
+                print("Exception: can't find this camera")
         except ValueError:
             print("Exception: enter number")
 
     if not cap.isOpened():
         print("Exception: can't open this camera")
+        cap.release()
         return None
-    return cap
-    
+    __save_cached_camera(selection, backend)
+    return CameraSource(cap)
 
 
-def list_cameras(max_to_check=5) -> list[tuple[int, str]]:
-    available = []
+# cameras are probed at once, missing devices can take seconds each, the ones which don't answer in time are skipped
+def list_cameras(max_to_check=5, timeout: float = probe_timeout) -> list[tuple[int, str]]:
+    results: queue.Queue = queue.Queue()
     for i in range(max_to_check):
-        cap = cv2.VideoCapture(i)
+        # probe threads can't be cancelled, hung ones are left behind as daemons
+        threading.Thread(target=lambda i=i: results.put(__probe_camera(i)), name=f"camera-probe-{i}", daemon=True).start()
+
+    available = []
+    deadline = time.monotonic() + timeout
+    for _ in range(max_to_check):
+        try:
+            result = results.get(timeout=max(deadline - time.monotonic(), 0))
+        except queue.Empty:
+            break
+        if result is not None:
+            available.append(result)
+    return sorted(available)
+
+
+def __probe_camera(index: int) -> tuple[int, str] | None:
+    cap = cv2.VideoCapture(index)
+    try:
         if cap.isOpened():
-            available.append((i, cap.getBackendName))
+            return index, cap.getBackendName()
+        return None
+    finally:
+        cap.release()
+
+
+def __open_cached_camera() -> cv2.VideoCapture | None:
+    try:
+        cached = json.loads(camera_cache_path.read_text())
+        index, backend = int(cached["index"]), str(cached["backend"])
+    except (OSError, ValueError, KeyError):
+        return None
+
+    cap = __call_with_timeout(lambda: cv2.VideoCapture(index, __get_backend_id(backend)), probe_timeout, lambda c: c.release())
+    if cap is None or not cap.isOpened():
+        print(f"Cached camera {index} ({backend}) isn't available")
+        if cap is not None:
             cap.release()
-    return available
+        return None
+    print(f"Cam {index} ({backend}) is used")
+    return cap
+
+
+def __save_cached_camera(index: int, backend: str) -> None:
+    try:
+        camera_cache_path.parent.mkdir(parents=True, exist_ok=True)
+        camera_cache_path.write_text(json.dumps({"index": index, "backend": backend}))
+    except OSError as e:
+        print(f"Exception: can't save the camera selection: {e}")
+
+
+def __get_backend_id(backend: str) -> int:
+    return getattr(cv2, f"CAP_{backend}", cv2.CAP_ANY)
 
+
+# result which comes after the timeout is given to cleanup, whoever takes it from the queue owns it
+def __call_with_timeout(function, timeout: float, cleanup=None):
+    results: queue.Queue = queue.Queue()
+    abandoned = threading.Event()
+
+    def take_late_result() -> None:
+        try:
+            result = results.get_nowait()
+        except queue.Empty:
+            return
+        if cleanup is not None:
+            cleanup(result)
+
+    def run() -> None:
+        results.put(function())
+        if abandoned.is_set():
+            take_late_result()
+
+    threading.Thread(target=run, daemon=True).start()
+    try:
+        return results.get(timeout=timeout)
+    except queue.Empty:
+        abandoned.set()
+        take_late_result()
+        return None
@@ -0,0 +1,87 @@
+import cv2
+import numpy as np
+from cv2.typing import MatLike
+from typing import Final
+
+from src.cv.chessboard.chessboard import wrapped_size
+
+
+check_cell_size: Final[int] = 20
+corner_offset: Final[int] = 2
+corner_size: Final[int] = 4
+
+# correlation between cell corners brightness and the chessboard pattern
+min_pattern_correlation: Final[float] = 0.6
+
+
+class BoardLock:
+    transform: np.ndarray
+    is_white_sided: bool
+
+    hits: int
+    misses: int
+
+    def __init__(self):
+        self.transform = None
+        self.is_white_sided = None
+        self.hits = 0
+        self.misses = 0
+        self.__pattern_sign = 0
+
+    def is_locked(self, is_white_sided: bool) -> bool:
+        return self.transform is not None and self.is_white_sided == is_white_sided
+
+    # returns False when the wrapped image doesn't look like a chessboard, lock is not taken then
+    def lock(self, transform: np.ndarray, is_white_sided: bool, wrapped: MatLike) -> bool:
+        correlation = calc_pattern_correlation(wrapped)
+        if abs(correlation) < min_pattern_correlation:
+            self.unlock()
+            return False
+
+        self.transform = transform
+        self.is_white_sided = is_white_sided
+        self.__pattern_sign = np.sign(correlation)
+        return True
+
+    def unlock(self) -> None:
+        self.transform = None
+        self.is_white_sided = None
+        self.__pattern_sign = 0
+
+    # returns None and unlocks when the board has drifted away from the locked position
+    def warp(self, image: MatLike) -> MatLike | None:
+        wrapped = cv2.warpPerspective(image, self.transform, (wrapped_size, wrapped_size))
+
+        if self.__pattern_sign * calc_pattern_correlation(wrapped) < min_pattern_correlation:
+            self.misses += 1
+            self.unlock()
+            return None
+
+        self.hits += 1
+        return wrapped
+
+
+# pieces stand in the middle of the cells, so only the cells corners are compared with the pattern
+def calc_pattern_correlation(wrapped: MatLike) -> float:
+    size = 8 * check_cell_size
+    gray = cv2.cvtColor(wrapped, cv2.COLOR_BGR2GRAY) if wrapped.ndim == 3 else wrapped
+    small = cv2.resize(gray, (size, size), interpolation=cv2.INTER_AREA).astype(np.float32)
+    cells = small.reshape(8, check_cell_size, 8, check_cell_size).transpose(0, 2, 1, 3)
+
+    near = slice(corner_offset, corner_offset + corner_size)
+    far = slice(check_cell_size - corner_offset - corner_size, check_cell_size - corner_offset)
+    corners = np.stack([
+        cells[:, :, near, near].mean(axis=(2, 3)),
+        cells[:, :, near, far].mean(axis=(2, 3)),
+        cells[:, :, far, near].mean(axis=(2, 3)),
+        cells[:, :, far, far].mean(axis=(2, 3)),
+    ])
+    values = np.median(corners, axis=0).ravel()
+
+    rows, cols = np.indices((8, 8))
+    pattern = ((rows + cols) % 2 * 2 - 1).ravel().astype(np.float32)
+
+    std = values.std()
+    if std == 0:
+        return 0.0
+    return float(np.mean((values - values.mean()) * pattern) / std)
@@ -0,0 +1,214 @@
+import argparse
+import pickle
+from pathlib import Path
+from typing import Final
+
+import cv2
+import numpy as np
+from cv2.typing import MatLike
+
+from src.cv.chessboard.chessboard import Position
+
+
+# cells are resized to tiles of this size before the features are calculated,
+# the wrapped board is downscaled 3 times then, which is the fast INTER_AREA case
+tile_size: Final[int] = 50
+# gray patch is the tile averaged to patch_size x patch_size blocks
+patch_size: Final[int] = 5
+value_bins: Final[int] = 8
+saturation_bins: Final[int] = 4
+# radius of the tile central part where the piece stands, tile size relative
+piece_radius: Final[float] = 0.33
+# tile borders, which are the cell's own background
+background_border: Final[float] = 0.1
+
+# labelled crops are named cell_<label>*.png
+crop_prefix: Final[str] = "cell_"
+crop_labels: Final[dict[str, Position]] = {"e": Position.EMPTY, "w": Position.WHITE, "b": Position.BLACK}
+# labelled boards are images with <name>.positions.txt beside them: 8 rows of E/W/B, the 8th rank first,
+# as src.batch prints them for the boards found as seen from the black side
+positions_suffix: Final[str] = ".positions.txt"
+default_augmentations: Final[int] = 400
+default_model_path: Final[str] = "models/cell_classifier.pkl"
+
+
+# Empty / white / black classifier of the cells tiles, all 64 cells of a board are predicted by one call
+class CellClassifier:
+    def __init__(self, model=None):
+        self.model = model
+
+    # labels are Position values
+    def fit(self, tiles: np.ndarray, labels: np.ndarray) -> 'CellClassifier':
+        # sklearn is slow to import, the game imports it only when the model is loaded
+        from sklearn.linear_model import LogisticRegression
+        from sklearn.pipeline import make_pipeline
+        from sklearn.preprocessing import StandardScaler
+
+        self.model = make_pipeline(StandardScaler(), LogisticRegression(max_iter=2000))
+        self.model.fit(calc_tiles_features(tiles), labels)
+        return self
+
+    # (n, tile_size, tile_size, 3) BGR tiles, returns (n,) Position values
+    def predict(self, tiles: np.ndarray) -> np.ndarray:
+        return self.model.predict(calc_tiles_features(tiles)).astype(np.int8)
+
+    # selected is (8, 8) bool mask in positions order, returns Position values of the selected cells
+    # or (8, 8) ones of the whole board
+    def classify_board(self, wrapped: MatLike, selected: np.ndarray = None) -> np.ndarray:
+        if selected is not None:
+            return self.predict(get_board_tiles(wrapped, selected))
+        return self.predict(get_board_tiles(wrapped).reshape(64, tile_size, tile_size, 3)).reshape(8, 8)
+
+    # pickled, see load_classifier
+    def save(self, path: str | Path) -> None:
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'wb') as f:
+            pickle.dump(self.model, f)
+
+
+# the model is unpickled, which runs any code the file holds, so it must come from a trusted path only
+def load_classifier(path: str | Path) -> CellClassifier:
+    with open(path, 'rb') as f:
+        return CellClassifier(pickle.load(f))
+
+
+# (8, 8, size, size, 3) tiles in positions order (row 0 is the bottom one), or (n, size, size, 3) tiles
+# of the cells selected by (8, 8) bool mask. Only the selected cells are resized, as one image of cells column,
+# INTER_AREA averages the same pixels as for the whole board then
+def get_board_tiles(wrapped: MatLike, selected: np.ndarray = None, size: int = tile_size) -> np.ndarray:
+    if selected is None:
+        image = cv2.resize(wrapped, (8 * size, 8 * size), interpolation=cv2.INTER_AREA)
+        return image.reshape(8, size, 8, size, 3).swapaxes(1, 2)[::-1]
+
+    cell_size = wrapped.shape[0] // 8
+    cells = wrapped.reshape(8, cell_size, 8, cell_size, 3).swapaxes(1, 2)[::-1][selected]
+    column = np.ascontiguousarray(cells).reshape(-1, cell_size, 3)
+    column = cv2.resize(column, (size, size * len(cells)), interpolation=cv2.INTER_AREA)
+    return column.reshape(-1, size, size, 3)
+
+
+# (n, features): contrast normalized gray patch, value and saturation histograms of the piece part,
+# its Lab difference from the tile borders and its edges density
+def calc_tiles_features(tiles: np.ndarray) -> np.ndarray:
+    n, t = len(tiles), tile_size
+    piece_mask, border_mask = __get_tile_masks()
+
+    # tiles are converted as one image of tiles column
+    flat = np.ascontiguousarray(tiles).reshape(n * t, t, 3)
+    gray = cv2.cvtColor(flat, cv2.COLOR_BGR2GRAY)
+    hsv = cv2.cvtColor(flat, cv2.COLOR_BGR2HSV).reshape(n, t, t, 3)
+    lab = cv2.cvtColor(flat, cv2.COLOR_BGR2LAB).reshape(n, t, t, 3).astype(np.float32)
+    edges = cv2.Canny(gray, 80, 160).reshape(n, t, t)
+    gray = gray.reshape(n, t, t)
+
+    b = t // patch_size
+    patch = gray.reshape(n, patch_size, b, patch_size, b).mean(axis=(2, 4)).reshape(n, -1)
+    patch = (patch - patch.mean(axis=1, keepdims=True)) / (patch.std(axis=1, keepdims=True) + 10)
+
+    piece_hsv = hsv[:, piece_mask]
+    value_hist = __calc_histograms(piece_hsv[..., 2], value_bins)
+    saturation_hist = __calc_histograms(piece_hsv[..., 1], saturation_bins)
+
+    lab_difference = (lab[:, piece_mask].mean(axis=1) - lab[:, border_mask].mean(axis=1)) / 255
+    edges_part = (edges[:, piece_mask] > 0).mean(axis=1, keepdims=True)
+
+    return np.hstack([patch, value_hist, saturation_hist, lab_difference, edges_part]).astype(np.float32)
+
+
+# crops of any size are resized to tiles, returns tiles and Position values of their labels
+def load_labelled_tiles(directory: str | Path) -> tuple[np.ndarray, np.ndarray]:
+    tiles, labels = [], []
+    for path in sorted(Path(directory).glob(f"{crop_prefix}*.png")):
+        label = crop_labels.get(path.name[len(crop_prefix):][:1])
+        image = cv2.imread(str(path))
+        if label is None or image is None:
+            continue
+        tiles.append(cv2.resize(image, (tile_size, tile_size), interpolation=cv2.INTER_AREA))
+        labels.append(label.value)
+    return np.stack(tiles), np.int8(labels)
+
+
+# random copies of the tiles: flips, rotations, shifts, scale, brightness, contrast, color cast and noise,
+# the lighting and the board position differ between the games
+def augment_tiles(tiles: np.ndarray, labels: np.ndarray, count: int, seed: int = 0) -> tuple[np.ndarray, np.ndarray]:
+    rng = np.random.default_rng(seed)
+    t = tile_size
+    result = []
+    indices = rng.integers(len(tiles), size=count)
+    for i in indices:
+        tile = np.rot90(tiles[i], int(rng.integers(4)))
+        if rng.random() < 0.5:
+            tile = tile[:, ::-1]
+
+        angle, scale = rng.uniform(-8, 8), rng.uniform(0.9, 1.1)
+        M = cv2.getRotationMatrix2D((t / 2, t / 2), angle, scale)
+        M[:, 2] += rng.uniform(-0.06, 0.06, size=2) * t
+        tile = cv2.warpAffine(np.ascontiguousarray(tile), M, (t, t), borderMode=cv2.BORDER_REFLECT)
+
+        tile = tile.astype(np.float32) * rng.uniform(0.6, 1.4) + rng.uniform(-40, 40)
+        tile = (tile - tile.mean()) * rng.uniform(0.7, 1.3) + tile.mean()
+        tile *= rng.uniform(0.85, 1.15, size=3)
+        tile += rng.normal(0, rng.uniform(0, 8), size=tile.shape)
+        result.append(np.clip(tile, 0, 255).astype(np.uint8))
+    return np.concatenate([tiles, np.stack(result)]), np.concatenate([labels, labels[indices]])
+
+
+# cells of the labelled boards are tiles too, boards are found the same way as in the game
+def load_labelled_boards(directory: str | Path) -> tuple[np.ndarray, np.ndarray]:
+    from src.cv.chessboard_find import find_chessboard
+
+    names = {p.name[0]: p.value for p in Position}
+    tiles, labels = [], []
+    for labels_path in sorted(Path(directory).glob(f"*{positions_suffix}")):
+        image_path = next(
+            (p for p in labels_path.parent.glob(labels_path.name[:-len(positions_suffix)] + ".*") if p.suffix != ".txt"),
+            None
+        )
+        image = cv2.imread(str(image_path)) if image_path is not None else None
+        chessboard = find_chessboard(image, is_white_sided=False) if image is not None else None
+        if chessboard is None:
+            print(f"Exception: can't find the board of {labels_path}")
+            continue
+
+        rows = labels_path.read_text().split()
+        tiles.append(get_board_tiles(chessboard.wrapped).reshape(64, tile_size, tile_size, 3))
+        labels.append(np.int8([[names[c] for c in row] for row in reversed(rows)]).reshape(64))
+    if len(tiles) == 0:
+        return np.empty((0, tile_size, tile_size, 3), np.uint8), np.empty(0, np.int8)
+    return np.concatenate(tiles), np.concatenate(labels)
+
+
+def train_classifier(directory: str | Path, augmentations: int = default_augmentations) -> CellClassifier:
+    crop_tiles, crop_tile_labels = load_labelled_tiles(directory)
+    board_tiles, board_labels = load_labelled_boards(directory)
+    tiles, labels = augment_tiles(
+        np.concatenate([crop_tiles, board_tiles]), np.concatenate([crop_tile_labels, board_labels]), augmentations
+    )
+    return CellClassifier().fit(tiles, labels)
+
+
+# (n, k) values, returns (n, bins) parts of the values in the bins
+def __calc_histograms(values: np.ndarray, bins: int) -> np.ndarray:
+    n, k = values.shape
+    indices = values.astype(np.int32) * bins // 256 + bins * np.arange(n)[:, None]
+    return np.bincount(indices.ravel(), minlength=n * bins).reshape(n, bins) / k
+
+
+def __get_tile_masks() -> tuple[np.ndarray, np.ndarray]:
+    t = tile_size
+    y, x = (np.indices((t, t)) + 0.5) / t - 0.5
+    piece_mask = np.hypot(x, y) < piece_radius
+    border_mask = np.maximum(np.abs(x), np.abs(y)) > 0.5 - background_border
+    return piece_mask, border_mask
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Train the cells classifier on labelled crops')
+    parser.add_argument('--data', type=str, default='data', help="Directory with cell_<e|w|b>*.png crops")
+    parser.add_argument('--augmentations', type=int, default=default_augmentations, help="Random copies of the crops added to the training set")
+    parser.add_argument('--output', type=str, default=default_model_path, help="Pickle file for the model")
+    args = parser.parse_args()
+
+    classifier = train_classifier(args.data, args.augmentations)
+    classifier.save(args.output)
+    print(f"Model is saved to {args.output}")
@@ -2,9 +2,13 @@ from dataclasses import dataclass
 import cv2
 from cv2.typing import MatLike
 from enum import Enum
+from typing import Final
 import numpy as np
 
-from src.cv import utils
+from src.cv.debug import get_debug_sink
+
+
+wrapped_size: Final[int] = 1200
 
 
 class Position(Enum):
@@ -21,18 +25,34 @@ class Chessboard:
 
     positions: tuple[tuple[Position]]
 
+    # perspective transform from the source image to the wrapped one
+    transform: np.ndarray = None
+
+    # (8, 8) int8 Position values of positions
+    cells: np.ndarray = None
+
+    # cells which have been classified again for this board
+    dirty_cells: int = 64
+
+    # (8, 8) bool mask of the cells covered by hands, None when occlusions aren't detected
+    occluded: np.ndarray = None
+
     def corners_of(self, row, col) -> np.ndarray:
         return corners_of(self.mean_dx, self.mean_dy, row, col)
     
     def show_highlighted_squares(self, positions: list[tuple[int, int]]) -> None:
         print(positions)
+        sink = get_debug_sink()
+        if not sink.enabled:
+            return
+
         image = self.wrapped.copy()
 
         for i, j in positions:
             contours = [self.corners_of(i, j)]
             
             cv2.drawContours(image, contours, 0, (255, 0, 255), 2)
-        utils.show_image(image, "Found positions")
+        sink.emit("found_positions", image)
     
 
 def corners_of(mean_dx, mean_dy, row, col) -> np.ndarray:
@@ -2,36 +2,87 @@ import numpy as np
 from cv2.typing import MatLike
 from cv2 import getPerspectiveTransform, warpPerspective
 
-from src.cv.chessboard.chessboard import Chessboard
+from src import instrumentation
+from src.cv.chessboard.chessboard import Chessboard, wrapped_size
 from src.cv.chessboard.grid import Grid, create_grid
-from src.cv.chessboard.chessboard_position_check import build_positions
+from src.cv.chessboard.chessboard_position_check import PositionsCache, build_cells, to_positions
 from src.cv.chessboard.grid_expanding import expand_grid
 from src.cv.contours.square import Square
 
 
-def build_chess_board(rotated_image: MatLike, rotated_squares: list[Square], is_white_sided, is_test=False) -> Chessboard:
-    grid = create_grid(rotated_squares)
+# rotation is the matrix of process_rotation, the image itself isn't rotated
+def build_chess_board(
+    image: MatLike,
+    rotation: np.ndarray,
+    rotated_squares: list[Square],
+    is_white_sided,
+    is_test=False,
+    positions_cache: PositionsCache = None,
+    timestamp: float = None
+) -> Chessboard:
+    grid = find_grid(image, rotation, rotated_squares, is_test)
+    if grid is None:
+        return None
+    
+    with instrumentation.span("cv.warp"):
+        wrapped, M = get_wrapped_chessboard(grid, image, rotation, is_white_sided)
+    return create_chessboard(wrapped, M, positions_cache, timestamp)
+
+
+def find_grid(image: MatLike, rotation: np.ndarray, rotated_squares: list[Square], is_test=False) -> Grid | None:
+    with instrumentation.span("cv.create_grid"):
+        grid = create_grid(rotated_squares)
     if is_test:
         grid.print()
 
-    if __is_borders_empty(grid):
-        grid = expand_grid(rotated_image, grid, rotated_squares, is_test)
+    if is_borders_empty(grid):
+        with instrumentation.span("cv.expand_grid"):
+            grid = expand_grid(image, rotation, grid, rotated_squares, is_test)
 
-    if __is_borders_empty(grid):
+    if is_borders_empty(grid):
         print("Empty borders!")
         return None
-    
-    wrapped = __get_wrapped_chessboard(grid, rotated_image, is_white_sided)
+    return grid
+
+
+# timestamp is the image time for the positions cache
+def create_chessboard(
+    wrapped: MatLike,
+    transform: np.ndarray,
+    positions_cache: PositionsCache = None,
+    timestamp: float = None
+) -> Chessboard:
     h, w = wrapped.shape[:2]
     dx, dy = w/8, h/8
+    with instrumentation.span("cv.build_positions"):
+        if positions_cache is None:
+            cells, dirty_cells, occluded = build_cells(wrapped), 64, None
+        else:
+            cells, dirty_cells, occluded = positions_cache.build_cells(wrapped, timestamp), positions_cache.dirty_count, positions_cache.occluded
+
     return Chessboard(
         wrapped=wrapped,
         mean_dx=dx,
         mean_dy=dy,
-        positions=build_positions(dx, dy, wrapped)
+        positions=to_positions(cells),
+        transform=transform,
+        cells=cells,
+        dirty_cells=dirty_cells,
+        occluded=occluded
     )
 
-def __get_wrapped_chessboard(grid: Grid, rotated_image: MatLike, is_white_sided: bool):
+
+# rotation and perspective are combined, so the original image is resampled once
+def get_wrapped_chessboard(grid: Grid, image: MatLike, rotation: np.ndarray, is_white_sided: bool) -> tuple[MatLike, np.ndarray]:
+    M = getPerspectiveTransform(find_board_corners(grid), get_wrapped_corners(is_white_sided))
+    M = M @ np.vstack([rotation, [0, 0, 1]])
+
+    wrapped = warpPerspective(image, M, (wrapped_size, wrapped_size))
+    return wrapped, M
+
+
+# outer board corners in the grid's image: top left, bottom left, bottom right, top right
+def find_board_corners(grid: Grid) -> np.ndarray:
     left, top, right, bottom = [], [], [], []
     
     for i in range(8):
@@ -66,32 +117,33 @@ def __get_wrapped_chessboard(grid: Grid, rotated_image: MatLike, is_white_sided:
     ])
 
     # print(f"Intersections: {Fore.MAGENTA}{points}{Fore.RESET}")
+    return points
+
 
-    h, w = 1200, 1200
-    end_points = (
+# where board corners from find_board_corners go in the wrapped image
+def get_wrapped_corners(is_white_sided: bool) -> np.ndarray:
+    h, w = wrapped_size, wrapped_size
+    return (
         np.float32([[0, 0], [0, h], [w, h], [w, 0]]) if is_white_sided
         else np.float32([[w, h], [w, 0], [0, 0], [0, h]])
     )
-    M = getPerspectiveTransform(points, end_points)
-
-    wrapped = warpPerspective(rotated_image, M, (h, w))
-    return wrapped
 
 
-def __calc_line(points: np.ndarray) -> tuple[float, float]:
-    k, b = np.polyfit([p[0] for p in points], [p[1] for p in points], 1)
-    return k, b
+# (a, b, c) of the line a*x + b*y + c = 0 by total least squares, so vertical borders are fine too
+def __calc_line(points: np.ndarray) -> np.ndarray:
+    points = np.asarray(points, dtype=np.float64)
+    center = points.mean(axis=0)
+    _, _, vt = np.linalg.svd(points - center)
+    normal = vt[-1]
+    return np.array([normal[0], normal[1], -normal @ center])
 
 
-def __calc_intersection(l1, l2) -> tuple[int, int]:
-    k1, b1 = l1
-    k2, b2 = l2
-    x = abs((b1 - b2) / (k1 - k2))
-    y = abs(k1 * x + b1)
-    return int(x), int(y)
+def __calc_intersection(l1: np.ndarray, l2: np.ndarray) -> tuple[float, float]:
+    x, y, w = np.cross(l1, l2)
+    return x / w, y / w
 
 
-def __is_borders_empty(grid: Grid) -> bool:
+def is_borders_empty(grid: Grid) -> bool:
     def is_array_empty(array):
         for el in array:
             if el is not None:
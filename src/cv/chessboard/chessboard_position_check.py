@@ -1,113 +1,251 @@
+from dataclasses import dataclass
+from typing import Final
 from cv2.typing import MatLike
 import numpy as np
 import cv2
 
-from src.cv.chessboard.chessboard import corners_of, Position
-from src.cv import utils
-
-
-def build_positions(dx: float, dy: float, wrapped: MatLike) -> list[list[Position]]:
-    result = []
-    for row in range(8):
-        row_array = []
-        for col in range(8):
-            corners = corners_of(dx, dy, row, col)
-            row_array.append(
-                define_position_type(
-                    wrapped[
-                        corners[0][1] : corners[2][1], corners[0][0] : corners[2][0]
-                    ],
-                    is_black_cell=(8*row + col) % 2 == 0,
-                    # is_test=(row==7 and col==7)
-                )
-            )
-        result.append(tuple(row_array))
-    return tuple(result)
-
-
-def define_position_type(cell_image: np.ndarray, is_black_cell: bool, is_test=False) -> Position:
-    cell_size = cell_image.shape[0]
-    gray = cv2.cvtColor(cell_image, cv2.COLOR_BGR2GRAY)
-    
-    blurred = cv2.medianBlur(gray, 3)
-    edges = cv2.Canny(blurred, 60, 120, None, 3)
-
-    _, edges = cv2.threshold(edges, 150, 255, cv2.THRESH_BINARY)
-
-    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
-    edges = cv2.morphologyEx(edges, cv2.MORPH_CLOSE, kernel)
-
-    thresh = edges
-
-    contours = cv2.HoughCircles(
-        thresh, cv2.HOUGH_GRADIENT, 1, 
-        minDist=1,
-        param1=255, 
-        param2=20,
-        minRadius=int(cell_size/5), 
-        maxRadius=int(cell_size*0.6)
-    )
-    if is_test:
-        utils.show_image(cell_image)
-        utils.show_image(thresh)
-
-    if contours is None:
-        return Position.EMPTY
-    circles = np.uint16(contours[0, :])
-
-    if is_test:
-        __show_drafted_circles(circles, cell_image)
-    
-    center = (cell_size // 2, cell_size // 2)
-    max_area = 0.85 * (cell_size ** 2)
-    
-    valid_contours = []
-    for circle in circles:
-        area = np.pi * circle[2]**2
-        
-        if area > max_area:
-            continue
-        
-        dist = utils.calc_points_dist(center, (circle[0], circle[1]))
-        if dist > circle[2] * 1.3:
-            continue
-
-        valid_contours.append(circle)
-
-    
-    if is_test:
-        __show_drafted_circles(valid_contours, cell_image)
-    
-    if len(valid_contours) == 0:
-        return Position.EMPTY
-    
-    main_contour = max(valid_contours, key=lambda el: el[2])
-    
-    mask = np.zeros_like(gray)
-    cv2.circle(mask, (main_contour[0], main_contour[1]), main_contour[2], 255, -1)
-    
-    if is_test:
-        utils.show_image(mask)
-    
-    mean_color_bgr = cv2.mean(cell_image, mask=mask)[:3]
-    mean_color_hsv = cv2.cvtColor(np.uint8([[mean_color_bgr]]), cv2.COLOR_BGR2HSV)[0][0]
-    
-    if mean_color_hsv[2] > 120: 
-        piece_color = Position.WHITE
-    elif mean_color_hsv[2] < 70:
-        piece_color = Position.BLACK
-    else:
-        if is_black_cell:
-            piece_color = Position.BLACK if mean_color_hsv[2] < 150 else Position.WHITE
+from src.cv.chessboard.cell_classifier import CellClassifier, get_board_tiles
+from src.cv.chessboard.chessboard import Position
+from src.cv.chessboard.occlusion import OcclusionDetector
+
+
+# wrapped image is downscaled to 8 cells of this size before classification
+classification_cell_size: Final[int] = 50
+
+# radius of the cell central part where the piece stands, cell size relative
+piece_radius: Final[float] = 0.33
+# square ring close to the cell borders, which is used as the cell's own background
+background_ring: Final[tuple[float, float]] = (0.36, 0.44)
+
+# Lab distance from the background after which pixel is considered as a piece's one
+foreign_color_distance: Final[float] = 20
+# cell's border ring is considered as covered by a piece when it has more foreign pixels
+max_ring_foreign_part: Final[float] = 0.2
+dark_value: Final[int] = 60
+
+min_foreign_part: Final[float] = 0.3
+min_dark_part: Final[float] = 0.4
+# pieces of the same color as the cell are recognized by edges
+min_weak_foreign_part: Final[float] = 0.15
+min_edges_part: Final[float] = 0.06
+
+
+# downscaled cell size, which is used to find changed cells
+signature_cell_size: Final[int] = 8
+# mean gray difference after which the cell is classified again
+min_signature_difference: Final[float] = 8
+
+
+@dataclass
+class CellsFeatures:
+    # all arrays are (8, 8) in positions order (row 0 is the bottom one) or (n,) for selected cells
+    foreign_part: np.ndarray
+    dark_part: np.ndarray
+    edges_part: np.ndarray
+    piece_value: np.ndarray
+    is_black_cell: np.ndarray
+    # median Lab color of the cell's border ring, and whether a piece covers the ring
+    ring_color: np.ndarray
+    is_ring_covered: np.ndarray
+
+
+class PositionsCache:
+    signatures: np.ndarray
+    cells: np.ndarray
+    dirty_count: int
+    # trained classifier of the cells, the rules are used without it
+    classifier: CellClassifier | None
+    # occluded cells of the last image, None when occlusions aren't detected
+    occluded: np.ndarray | None
+    # rings of the cells at their last classification by the rules, the covered rings of the dirty cells
+    # are estimated from them
+    ring_colors: np.ndarray | None
+    covered_rings: np.ndarray | None
+
+    # occlusions are detected on continuous frames only, they are found by the changes between them
+    def __init__(self, classifier: CellClassifier = None, detect_occlusions: bool = False):
+        self.classifier = classifier
+        self.occlusion_detector = OcclusionDetector() if detect_occlusions else None
+        self.reset()
+
+    def reset(self) -> None:
+        self.signatures = None
+        self.cells = None
+        self.dirty_count = 64
+        self.occluded = None
+        self.ring_colors = None
+        self.covered_rings = None
+        if self.occlusion_detector is not None:
+            self.occlusion_detector.reset()
+
+    # only cells that differ from their image at the last classification are classified again,
+    # so slow changes are caught too. The result is a copy, cached cells are updated in place.
+    # Occluded cells aren't classified, so they are compared with their last state when they are visible again.
+    # timestamp is the image time in seconds, the current time by default
+    def build_cells(self, wrapped: MatLike, timestamp: float = None) -> np.ndarray:
+        signatures = calc_cells_signatures(wrapped)
+        if self.occlusion_detector is not None:
+            self.occluded = self.occlusion_detector.find_occluded(wrapped, timestamp)
+
+        if self.cells is None:
+            self.cells = self.__classify(wrapped)
+            self.dirty_count = 64
+            self.signatures = signatures
+        else:
+            dirty = np.abs(signatures - self.signatures).mean(axis=(2, 3)) > min_signature_difference
+            if self.occluded is not None:
+                dirty &= ~self.occluded
+            self.dirty_count = int(dirty.sum())
+            if self.dirty_count != 0:
+                self.cells[dirty] = self.__classify(wrapped, dirty)
+                self.signatures[dirty] = signatures[dirty]
+
+        return self.cells.copy()
+
+    def __classify(self, wrapped: MatLike, selected: np.ndarray = None) -> np.ndarray:
+        if self.classifier is not None:
+            return self.classifier.classify_board(wrapped, selected)
+
+        features = calc_cells_features(wrapped, selected, self.ring_colors, self.covered_rings)
+        if selected is None:
+            self.ring_colors, self.covered_rings = features.ring_color, features.is_ring_covered
         else:
-            piece_color = Position.WHITE if mean_color_hsv[2] > 100 else Position.BLACK
-    
-    return piece_color
+            self.ring_colors[selected] = features.ring_color
+            self.covered_rings[selected] = features.is_ring_covered
+        return classify_cells(features)
+
+
+# Position values of the cells, row 0 is the first rank, or (n,) values of the selected cells
+def build_cells(wrapped: MatLike, classifier: CellClassifier = None, selected: np.ndarray = None) -> np.ndarray:
+    if classifier is not None:
+        return classifier.classify_board(wrapped, selected)
+    return classify_cells(calc_cells_features(wrapped, selected))
+
+
+def calc_cells_signatures(wrapped: MatLike) -> np.ndarray:
+    s = signature_cell_size
+    gray = cv2.cvtColor(wrapped, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(gray, (8 * s, 8 * s), interpolation=cv2.INTER_AREA).astype(np.float32)
+    return __as_cells(small, s)
+
+
+# selected is (8, 8) bool mask in positions order, features are calculated for these cells only.
+# A covered ring of the selected cell is replaced with the other cells' rings, these are given by (8, 8) ring_colors
+# and covered_rings of the whole board, the other cells aren't used without them
+def calc_cells_features(
+    wrapped: MatLike,
+    selected: np.ndarray = None,
+    ring_colors: np.ndarray = None,
+    covered_rings: np.ndarray = None
+) -> CellsFeatures:
+    c = classification_cell_size
+    image_cells = get_board_tiles(wrapped, selected, c)
+    shape = image_cells.shape[:-3]
+
+    # tiles are converted as one image of tiles column, pixels are gathered only by masks then
+    column = np.ascontiguousarray(image_cells).reshape(-1, c, 3)
+    lab_cells = cv2.cvtColor(column, cv2.COLOR_BGR2LAB).reshape(image_cells.shape)
+    gray = cv2.cvtColor(column, cv2.COLOR_BGR2GRAY)
+    edges_cells = cv2.Canny(cv2.medianBlur(gray, 3), 60, 120, None, 3).reshape(*shape, c, c)
+
+    piece_mask, ring_mask = __get_cell_masks(c)
+    rows, cols = np.indices((8, 8))
+    is_black_cell = (rows + cols) % 2 == 0
+
+    ring_color, is_ring_covered = __calc_rings(lab_cells, ring_mask)
+    if selected is None:
+        background = __calc_background(ring_color, is_ring_covered, is_black_cell)
+    else:
+        board_colors = np.zeros((8, 8, 3), dtype=np.int32) if ring_colors is None else ring_colors.copy()
+        board_covered = np.ones((8, 8), dtype=bool) if covered_rings is None else covered_rings.copy()
+        board_colors[selected], board_covered[selected] = ring_color, is_ring_covered
+        background = __calc_background(board_colors, board_covered, is_black_cell)[selected]
+        is_black_cell = is_black_cell[selected]
+
+    diff = lab_cells[..., piece_mask, :].astype(np.int32) - background[..., None, :]
+    foreign = np.einsum('...kc,...kc->...k', diff, diff) > foreign_color_distance**2
+    foreign_count = foreign.sum(axis=-1)
+
+    colors = image_cells[..., piece_mask, :]
+    color_sums = np.einsum('...kc,...k->...c', colors, foreign, dtype=np.float32)
+    mean_colors = np.where(
+        (foreign_count > 0)[..., None],
+        color_sums / np.maximum(foreign_count, 1)[..., None],
+        colors.mean(axis=-2),
+    )
+    values = colors.max(axis=-1)
+
+    return CellsFeatures(
+        foreign_part=foreign_count / piece_mask.sum(),
+        dark_part=((values < dark_value) & foreign).mean(axis=-1),
+        edges_part=(edges_cells[..., piece_mask] > 0).mean(axis=-1),
+        piece_value=mean_colors.max(axis=-1),
+        is_black_cell=is_black_cell,
+        ring_color=ring_color,
+        is_ring_covered=is_ring_covered,
+    )
+
+
+# returns Position values array of the features shape
+def classify_cells(features: CellsFeatures) -> np.ndarray:
+    is_occupied = (
+        (features.foreign_part > min_foreign_part) |
+        (features.dark_part > min_dark_part) |
+        ((features.foreign_part > min_weak_foreign_part) & (features.edges_part > min_edges_part))
+    )
+
+    value = features.piece_value
+    is_white = (value > 120) | (
+        (value >= 70) & np.where(features.is_black_cell, value >= 150, value > 100)
+    )
+    is_white &= features.dark_part <= min_dark_part
+
+    result = np.full(is_occupied.shape, Position.EMPTY.value, dtype=np.int8)
+    result[is_occupied] = np.where(is_white, Position.WHITE.value, Position.BLACK.value)[is_occupied]
+    return result
+
+
+def to_positions(cells: np.ndarray) -> tuple[tuple[Position]]:
+    positions = tuple(Position)
+    return tuple(tuple(positions[v] for v in row) for row in cells.tolist())
+
+
+# (8, 8, c, c, ...) view in positions order, row 0 is the bottom one
+def __as_cells(image: np.ndarray, c: int) -> np.ndarray:
+    return image.reshape(8, c, 8, c, *image.shape[2:]).swapaxes(1, 2)[::-1]
+
+
+# median colors of the cells border rings and whether they are covered by pieces
+def __calc_rings(lab_cells: np.ndarray, ring_mask: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    rings = lab_cells[..., ring_mask, :].astype(np.int32)
+    colors = np.median(rings, axis=-2).astype(np.int32)
+
+    diff = rings - colors[..., None, :]
+    far_part = (np.einsum('...kc,...kc->...k', diff, diff) > foreign_color_distance**2).mean(axis=-1)
+    return colors, far_part > max_ring_foreign_part
+
+
+# (8, 8) cell's own border ring color, or the same colored cells one when a piece covers the ring
+def __calc_background(ring_colors: np.ndarray, is_covered: np.ndarray, is_black_cell: np.ndarray) -> np.ndarray:
+    background = ring_colors.copy()
+    # covered cells take the background of the nearest visible same colored cells, as lighting isn't even
+    rows, cols = np.indices((8, 8))
+    coords = np.stack([rows.ravel(), cols.ravel()], axis=1)
+    dist2 = ((coords[:, None, :] - coords[None, :, :])**2).sum(axis=2)
+    same_color = is_black_cell.ravel()[:, None] == is_black_cell.ravel()[None, :]
+    weights = np.where(same_color & ~is_covered.ravel()[None, :] & (dist2 > 0), 1 / np.maximum(dist2, 1)**2, 0)
+
+    weights_sum = weights.sum(axis=1)
+    estimated = (weights @ background.reshape(64, 3)) / np.maximum(weights_sum, 1e-9)[:, None]
+    replaced = is_covered.ravel() & (weights_sum > 0)
+    background.reshape(64, 3)[replaced] = estimated[replaced]
+    return background
+
 
+def __get_cell_masks(c: int) -> tuple[np.ndarray, np.ndarray]:
+    ys, xs = np.indices((c, c)) - (c - 1) / 2
+    piece_mask = ys**2 + xs**2 <= (piece_radius * c)**2
 
-def __show_drafted_circles(circles: np.ndarray, image) -> None:
-    print("Contours:", len(circles))
-    img = image.copy()
-    for x, y, r in circles:
-        cv2.circle(img, (x, y), r, (0, 255, 0), 2)
-    utils.show_image(img)
\ No newline at end of file
+    dist = np.maximum(np.abs(xs), np.abs(ys))
+    ring_mask = (background_ring[0] * c <= dist) & (dist <= background_ring[1] * c)
+    return piece_mask, ring_mask
@@ -1,13 +1,26 @@
 from dataclasses import dataclass
+from typing import Final
 
+import cv2
 import numpy as np
 
+from src import instrumentation
 from src.cv.contours.square import Square
 
 
+# square center further from the lattice point than this (cells) isn't a board cell
+max_lattice_error: Final[float] = 0.3
+# lattice is fitted on the squares closer than these radii (cells) to the central one in turn
+lattice_fit_radii: Final[tuple[float]] = (1, 3, 8)
+# 3x3 cells around the central square are fitted by affine transform
+min_homography_points: Final[int] = 12
+
+
 @dataclass
 class Grid:
     coords: list[list[Square]]
+    # 3x3 matrix from (col, row) coords to the cells centers in the image
+    lattice: np.ndarray = None
 
     def print(self):
         for row in self.coords:
@@ -44,42 +57,75 @@ class Grid:
         return x, y
     
 
+# squares are snapped to the lattice fitted to all their centers at once, so a stray square
+# doesn't shift the others, it is dropped instead
 def create_grid(squares: list[Square]) -> Grid:
-    if not squares:
-        return Grid([[None for _ in range(8)] for _ in range(8)])
     grid = [[None for _ in range(8)] for _ in range(8)]
-
-    mean_w = np.mean([s.w for s in squares])
-    mean_h = np.mean([s.h for s in squares])
-    
-    # rows
-    squares_y_sorted = sorted(squares, key=lambda s: s.y)
-    current_row = 0
-    last_square = squares_y_sorted[0]
-    last_square.row_num = current_row
-
-    for i in range(1, len(squares_y_sorted)):
-        current_square = squares_y_sorted[i]
-        d_rows = round((current_square.y - last_square.y) / mean_w)
-        current_row += d_rows
-        current_square.row_num = min(current_row, 7)
-        last_square = current_square
-        
-    # cols
-    squares_x_sorted = sorted(squares, key=lambda s: s.x)
-    current_col = 0
-    last_square = squares_x_sorted[0]
-    last_square.col_num = current_col
-
-    for i in range(1, len(squares_x_sorted)):
-        current_square = squares_x_sorted[i]
-        d_rows = round((current_square.x - last_square.x) / mean_h)
-        current_col += d_rows
-        current_square.col_num = min(current_col, 7)
-        last_square = current_square
-
-
-    for s in squares:
+    if not squares:
+        return Grid(grid)
+
+    centers = np.stack([s.approx for s in squares]).mean(axis=1)
+    pitch = np.median(np.array([(s.w, s.h) for s in squares]), axis=0)
+    lattice = __fit_lattice(centers, pitch)
+
+    points = cv2.perspectiveTransform(centers[None], np.linalg.inv(lattice))[0]
+    coords = np.round(points).astype(np.int64)
+    errors = np.abs(points - coords).max(axis=1)
+    is_inlier = errors < max_lattice_error
+
+    # the 8 cells window with the most squares, first row and col with squares go first
+    cols, rows = coords[:, 0], coords[:, 1]
+    col_0 = __find_window_start(cols[is_inlier])
+    row_0 = __find_window_start(rows[is_inlier])
+    cols, rows = cols - col_0, rows - row_0
+    is_inlier &= (0 <= cols) & (cols < 8) & (0 <= rows) & (rows < 8)
+    instrumentation.observe_value("cv.grid_outliers", int((~is_inlier).sum()))
+
+    # the closest to the lattice square wins when several are snapped to one cell
+    for i in np.flatnonzero(is_inlier)[np.argsort(-errors[is_inlier], kind='stable')]:
+        s = squares[i]
+        s.row_num, s.col_num = int(rows[i]), int(cols[i])
         grid[s.row_num][s.col_num] = s
-    
-    return Grid(grid)
+
+    shift = np.array([[1, 0, col_0], [0, 1, row_0], [0, 0, 1]], dtype=np.float64)
+    return Grid(grid, lattice @ shift)
+
+
+# returns 3x3 matrix from (col, row) lattice coords to the image points, it is fitted near
+# the central square first and then on the growing area, as perspective bends the lattice
+def __fit_lattice(centers: np.ndarray, pitch: np.ndarray) -> np.ndarray:
+    anchor = centers[np.argmin(np.linalg.norm(centers - np.median(centers, axis=0), axis=1))]
+    lattice = np.array([[pitch[0], 0, anchor[0]], [0, pitch[1], anchor[1]], [0, 0, 1]], dtype=np.float64)
+
+    for radius in lattice_fit_radii:
+        points = cv2.perspectiveTransform(centers[None], np.linalg.inv(lattice))[0]
+        coords = np.round(points)
+        selected = (np.abs(points - coords).max(axis=1) < max_lattice_error) & (np.abs(coords).max(axis=1) <= radius)
+        # both directions are needed to fit anything
+        if len(np.unique(coords[selected, 0])) < 2 or len(np.unique(coords[selected, 1])) < 2:
+            break
+        lattice = __fit_transform(coords[selected], centers[selected])
+    return lattice
+
+
+# least squares transform from src to dst, homography when there are enough points
+def __fit_transform(src: np.ndarray, dst: np.ndarray) -> np.ndarray:
+    if len(src) >= min_homography_points:
+        H, _ = cv2.findHomography(src, dst, 0)
+        if H is not None:
+            return H
+    A = np.hstack([src, np.ones((len(src), 1))])
+    X, *_ = np.linalg.lstsq(A, dst, rcond=None)
+    return np.vstack([X.T, [0, 0, 1]])
+
+
+def __find_window_start(values: np.ndarray) -> int:
+    if len(values) == 0:
+        return 0
+    v_min = values.min()
+    counts = np.bincount(values - v_min)
+    if len(counts) <= 8:
+        return int(v_min)
+    # squares count in the 8 cells window started at each value
+    window_counts = np.convolve(counts, np.ones(8, dtype=np.int64))[7:]
+    return int(v_min + np.argmax(window_counts))
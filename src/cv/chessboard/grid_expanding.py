@@ -1,113 +1,147 @@
 import cv2
 from cv2.typing import MatLike
 import numpy as np
+from typing import Final
 
+from src import instrumentation
 from src.cv import utils
+from src.cv.debug import get_debug_sink
 from src.cv.chessboard.grid import Grid, create_grid
+from src.cv.contours.rotation import get_rotated_region, get_rotated_image
 from src.cv.contours.square import Square
 
 
-def expand_grid(rotated_image: MatLike, grid: Grid, rotated_squares: list[Square], is_test=False) -> Grid:
-    gray = cv2.cvtColor(rotated_image, cv2.COLOR_BGR2GRAY)
+# circle center further from the cell center than this (cells) isn't a piece on the cell
+max_circle_error: Final[float] = 0.35
 
-    mean_w = np.mean([s.w for s in rotated_squares])
-    mean_h = np.mean([s.h for s in rotated_squares])
-    far_x, e_cols, far_y, e_rows = grid.calc_empty_stats()
-    close_x, close_y = grid.get_closest_coords()
 
-    m = 1
-    x_0 = int(max(0, close_x - e_cols*mean_w*m))
-    y_0 = int(max(0, close_y - e_rows*mean_h*m))
-
-    h, w = gray.shape
-    x_1 = int(min(w, far_x + e_cols*mean_w*m))
-    y_1 = int(min(h, far_y + e_rows*mean_h*m))
-    if is_test:
-        print(f'{x_0}:{x_1}, {y_0}:{y_1}')
-    wrapped = gray[y_0:y_1, x_0:x_1]
-
-    edges = utils.get_edges(gray=wrapped, iterations=1)
-
-    cell_size = (mean_h + mean_w)/2 * m
-
-    contours = cv2.HoughCircles(
-        edges, cv2.HOUGH_GRADIENT, 1, 
-        minDist=0.5 * cell_size,
-        param1=255, 
-        param2=20,
-        minRadius=int(0.7*cell_size/2), 
-        maxRadius=int(cell_size/2)
-    )
+# rotation is the matrix of process_rotation, rotated_squares and grid are in its coordinates.
+# Empty rows and cols may be on either side of the found squares, so pieces are searched in the strips of
+# missing cells on both sides only, every found piece gives the square of its cell
+def expand_grid(image: MatLike, rotation: np.ndarray, grid: Grid, rotated_squares: list[Square], is_test=False) -> Grid:
+    if grid.lattice is None:
+        return grid
+    _, e_cols, _, e_rows = grid.calc_empty_stats()
+    cell_size = (np.mean([s.w for s in rotated_squares]) + np.mean([s.h for s in rotated_squares])) / 2
+
+    sink = get_debug_sink()
+    circles = []
+    for cols, rows in __get_strips(e_cols, e_rows):
+        x_0, y_0, x_1, y_1 = __get_cells_bounds(grid.lattice, cols, rows, image.shape)
+        if x_1 - x_0 < cell_size / 2 or y_1 - y_0 < cell_size / 2:
+            continue
+        if is_test:
+            print(f'{x_0}:{x_1}, {y_0}:{y_1}')
+        strip = get_rotated_region(image, rotation, x_0, y_0, x_1, y_1, color_conversion=cv2.COLOR_BGR2GRAY)
+        edges = utils.get_edges(gray=strip, iterations=1)
+
+        found = cv2.HoughCircles(
+            edges, cv2.HOUGH_GRADIENT, 1,
+            minDist=0.5 * cell_size,
+            param1=255,
+            param2=20,
+            minRadius=int(0.7*cell_size/2),
+            maxRadius=int(cell_size/2)
+        )
+        if sink.enabled:
+            sink.emit("expand_region", strip)
+            sink.emit("expand_edges", edges)
+        if found is not None:
+            circles.append(found[0] + (x_0, y_0, 0))
 
-    if contours is None:
+    if len(circles) == 0:
         print("No circles")
         return grid
-    
-    circles = np.uint16(contours[0, :])
+    circles = np.concatenate(circles)
+    instrumentation.observe_value("cv.expand_grid_circles", len(circles))
     if is_test:
         print(f"Circles detected = {len(circles)}")
 
-    new_squares = __get_new_squares(
-        circles, grid, close_x, close_y, far_x, far_y, x_0, y_0, mean_w, mean_h, e_rows, e_cols
-    )
-    
+    new_squares = __get_new_squares(circles, grid.lattice, e_cols, e_rows)
     if is_test:
-        utils.show_image(wrapped)
-        image = rotated_image.copy()
         print(len(new_squares))
-        
+
+    if sink.enabled:
+        rotated_image = get_rotated_image(image, rotation)
         for s in new_squares:
-            cv2.drawContours(image, [s.approx], 0, (255, 0, 255), 2)
-        for x, y, r in circles:
-            cv2.circle(image, (x_0+x, y_0+y), r, (0, 0, 255), 2)
-        utils.show_image(image, "By circles positions")
+            cv2.drawContours(rotated_image, [s.approx], 0, (255, 0, 255), 2)
+        for x, y, r in np.int32(circles):
+            cv2.circle(rotated_image, (x, y), r, (0, 0, 255), 2)
+        sink.emit("expand_circles", rotated_image)
 
     rotated_squares.extend(new_squares)
 
     return create_grid(rotated_squares)
 
 
-def __get_new_squares(
-        circles: list[MatLike],
-        grid: Grid,
-        close_x, close_y, far_x, far_y,
-        x_0, y_0,
-        mean_w, mean_h,
-        e_rows, e_cols
-) -> list[Square]:
-    new_squares: list[Square] = []
-    for x, y, _ in circles:
-        if close_x-x_0 <= x <= far_x-x_0 and close_y-y_0 <= y <= far_y-y_0:
-            continue
-        # top left corner
-        tl_x = int(x_0 + x - 0.5*mean_w)
-        tl_y = int(y_0 + y - 0.5*mean_h)
-
-        mean_approx = np.zeros((4, 2), dtype=np.float32)
-        counter = 0
-        if x < close_x-x_0 or x > far_x-x_0:
-            col_n = 0 if x < close_x-x_0 else 7 - e_cols
-            for i in range(8):
-                s = grid.coords[i][col_n]
-                if s is None:
-                    continue
-                counter += 1
-                mean_approx += s.approx - s.approx[0]
-        elif y < close_y-y_0 or y > far_y-y_0:
-            row_n = 0 if y < close_y-y_0 else 7 - e_rows
-            for s in grid.coords[row_n]:
-                if s is None:
-                    continue
-                counter += 1
-                mean_approx += s.approx - s.approx[0]
-        
-        mean_approx = (mean_approx / counter) + (tl_x, tl_y)
-
-        new_squares.append(
-            Square(
-                tl_x, tl_y, mean_w, mean_h, 
-                area=mean_w*mean_h,
-                approx=np.int32(mean_approx)
-            )
-        )
+# (cols, rows) ranges of the missing cells: the found squares take 8 - e_cols cols from 0,
+# so missing ones are either before 0 or after them, corners are in the left and right strips
+def __get_strips(e_cols: int, e_rows: int) -> list[tuple[tuple[int, int], tuple[int, int]]]:
+    strips = []
+    if e_cols != 0:
+        strips.append(((-e_cols, -1), (-e_rows, 7)))
+        strips.append(((8 - e_cols, 7), (-e_rows, 7)))
+    if e_rows != 0:
+        strips.append(((0, 7 - e_cols), (-e_rows, -1)))
+        strips.append(((0, 7 - e_cols), (8 - e_rows, 7)))
+    return strips
+
+
+# rotated image bounds x_0, y_0, x_1, y_1 of the inclusive cols and rows ranges
+def __get_cells_bounds(lattice: np.ndarray, cols: tuple[int, int], rows: tuple[int, int], shape) -> tuple[int, int, int, int]:
+    corners = np.float64([
+        [cols[0] - 0.5, rows[0] - 0.5], [cols[1] + 0.5, rows[0] - 0.5],
+        [cols[1] + 0.5, rows[1] + 0.5], [cols[0] - 0.5, rows[1] + 0.5],
+    ])
+    points = cv2.perspectiveTransform(corners[None], lattice)[0]
+    h, w = shape[:2]
+    x_0, y_0 = np.clip(np.floor(points.min(axis=0)).astype(int), 0, (w, h))
+    x_1, y_1 = np.clip(np.ceil(points.max(axis=0)).astype(int), 0, (w, h))
+    return int(x_0), int(y_0), int(x_1), int(y_1)
+
+
+# circles are snapped to the missing cells all at once, the closest circle takes the cell
+def __get_new_squares(circles: np.ndarray, lattice: np.ndarray, e_cols: int, e_rows: int) -> list[Square]:
+    points = cv2.perspectiveTransform(np.float64(circles[None, :, :2]), np.linalg.inv(lattice))[0]
+    coords = np.round(points).astype(np.int64)
+    errors = np.abs(points - coords).max(axis=1)
+    cols, rows = coords[:, 0], coords[:, 1]
+
+    is_close = errors < max_circle_error
+    # board is 8 cells wide, so missing cells before 0 and after the found ones are taken
+    # in the split with the most pieces
+    cols_before = __find_missing_split(cols[is_close], e_cols)
+    rows_before = __find_missing_split(rows[is_close], e_rows)
+    is_board = (
+        (-cols_before <= cols) & (cols <= 7 - cols_before) &
+        (-rows_before <= rows) & (rows <= 7 - rows_before)
+    )
+    is_found = (0 <= cols) & (cols <= 7 - e_cols) & (0 <= rows) & (rows <= 7 - e_rows)
+    selected = np.flatnonzero(is_board & ~is_found & is_close)
+
+    selected = selected[np.argsort(errors[selected], kind='stable')]
+    _, first = np.unique(coords[selected], axis=0, return_index=True)
+    selected = selected[first]
+    if len(selected) == 0:
+        return []
+
+    # cells corners in the squares order: top left, bottom left, bottom right, top right
+    offsets = np.float64([[-0.5, -0.5], [-0.5, 0.5], [0.5, 0.5], [0.5, -0.5]])
+    corners = (coords[selected][:, None, :] + offsets).reshape(-1, 2)
+    approx = np.int32(cv2.perspectiveTransform(corners[None], lattice)[0]).reshape(-1, 4, 2)
+
+    new_squares = []
+    for a in approx:
+        w = (np.linalg.norm(a[3] - a[0]) + np.linalg.norm(a[2] - a[1])) / 2
+        h = (np.linalg.norm(a[1] - a[0]) + np.linalg.norm(a[2] - a[3])) / 2
+        new_squares.append(Square(int(a[0, 0]), int(a[0, 1]), float(w), float(h), area=float(w*h), approx=a))
     return new_squares
+
+
+# returns how many of the empty lines are before the found ones
+def __find_missing_split(values: np.ndarray, empty_count: int) -> int:
+    counts = [
+        int(((-before <= values) & (values < 0)).sum() + ((8 - empty_count <= values) & (values <= 7 - before)).sum())
+        for before in range(empty_count + 1)
+    ]
+    return int(np.argmax(counts))
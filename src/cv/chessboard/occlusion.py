@@ -0,0 +1,81 @@
+import time
+from typing import Final
+
+import cv2
+import numpy as np
+from cv2.typing import MatLike
+
+
+# wrapped board is compared in gray cells of this size, 1200 px board is downscaled 10 times then
+occlusion_cell_size: Final[int] = 15
+# gray difference from the reference after which the pixel is considered as changed
+min_changed_difference: Final[int] = 25
+# changed region is an occluder when it's larger than this many cells and comes from the board border,
+# a move changes up to 4 cells (castling) only partially, hands and arms are larger and come from outside
+min_occluder_cells: Final[float] = 3.0
+# cell is occluded when this part of it is covered by an occluder
+min_occluded_part: Final[float] = 0.15
+# occluder, which doesn't move for this many seconds, is accepted as a part of the board.
+# It's much longer than a hand stays still while reaching for pieces, so a resting hand isn't read as pieces
+max_static_seconds: Final[float] = 5.0
+max_static_difference: Final[float] = 4
+
+
+# Hands and arms over the board of the continuous frames. The frame is compared with the reference one,
+# which is the last frame without occluders
+class OcclusionDetector:
+    def __init__(self):
+        self.reset()
+
+    def reset(self) -> None:
+        self.__reference: np.ndarray = None
+        self.__previous: np.ndarray = None
+        # time since the occluder hasn't moved
+        self.__static_since: float = None
+
+    # (8, 8) bool mask of the occluded cells in positions order (row 0 is the bottom one),
+    # timestamp is the frame time in seconds, the current monotonic time by default
+    def find_occluded(self, wrapped: MatLike, timestamp: float = None) -> np.ndarray:
+        timestamp = timestamp if timestamp is not None else time.monotonic()
+        s = occlusion_cell_size
+        small = cv2.resize(wrapped, (8 * s, 8 * s), interpolation=cv2.INTER_AREA)
+        small = cv2.GaussianBlur(cv2.cvtColor(small, cv2.COLOR_BGR2GRAY), (5, 5), 0)
+
+        previous, self.__previous = self.__previous, small
+        if self.__reference is None:
+            self.__reference = small
+            return np.zeros((8, 8), dtype=bool)
+
+        mask = self.__find_occluders(small)
+        if mask is None:
+            self.__reference = small
+            self.__static_since = None
+            return np.zeros((8, 8), dtype=bool)
+
+        # the lighting or the board could have changed, it's the new reference when it stays the same
+        if previous is None or cv2.absdiff(small, previous)[mask].mean() >= max_static_difference:
+            self.__static_since = timestamp
+        elif self.__static_since is None:
+            self.__static_since = timestamp
+        if timestamp - self.__static_since >= max_static_seconds:
+            self.__reference = small
+            self.__static_since = None
+            return np.zeros((8, 8), dtype=bool)
+
+        covered = mask.reshape(8, s, 8, s).mean(axis=(1, 3))
+        return (covered > min_occluded_part)[::-1]
+
+    # mask of the occluders pixels or None
+    def __find_occluders(self, small: np.ndarray) -> np.ndarray | None:
+        size = small.shape[0]
+        changed = (cv2.absdiff(small, self.__reference) > min_changed_difference).astype(np.uint8)
+        changed = cv2.morphologyEx(changed, cv2.MORPH_OPEN, np.ones((3, 3), dtype=np.uint8))
+
+        count, labels, stats, _ = cv2.connectedComponentsWithStats(changed, connectivity=8)
+        x, y, w, h, area = stats[1:].T
+        is_occluder = (area >= min_occluder_cells * occlusion_cell_size**2) & (
+            (x == 0) | (y == 0) | (x + w == size) | (y + h == size)
+        )
+        if not is_occluder.any():
+            return None
+        return np.isin(labels, np.flatnonzero(is_occluder) + 1)
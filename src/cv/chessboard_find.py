@@ -1,52 +1,222 @@
 import time
+from typing import Final
 import cv2
 from cv2.typing import MatLike
 import numpy as np
 from colorama import Fore
 
+from src import instrumentation
 from src.cv import utils
+from src.cv.debug import DebugSink, get_debug_sink
 from src.cv.chessboard.chessboard import Position
-from src.cv.contours.rotation import process_rotation
+from src.cv.contours.rotation import process_rotation, get_rotated_image
 from src.cv.contours.square import filter_squares, cluster_squares, Square
-from src.cv.chessboard.chessboard_builder import build_chess_board, Chessboard
+from src.cv.chessboard.chessboard_builder import (
+    build_chess_board, create_chessboard, find_grid, find_board_corners, get_wrapped_corners, Chessboard
+)
+from src.cv.chessboard.chessboard import wrapped_size
+from src.cv.chessboard.board_lock import BoardLock
+from src.cv.chessboard.chessboard_position_check import PositionsCache, build_cells
 
 
-def find_chessboard(image: MatLike, is_white_sided, is_test=False) -> Chessboard:
-    # pre-process image
+# refined corner may move at most this many full resolution pixels per downscale factor
+refine_window_per_scale: Final[float] = 1.5
+max_refine_window: Final[int] = 15
+
+
+# opencv and numpy set up their internals on the first calls, so the first detection is several times slower.
+# The slow stages are run on synthetic data here, they don't print and don't emit debug images
+def warm_up() -> None:
+    build_cells(np.zeros((wrapped_size, wrapped_size, 3), dtype=np.uint8))
+    points = np.float32(np.indices((4, 4)).reshape(2, -1).T)
+    cv2.findHomography(points, points * 2 + 1, 0)
+
+
+# detection_size is the longest side of the image copy where the board is searched,
+# the board is wrapped from the full resolution image anyway. timestamp is the image time in seconds,
+# occlusions of the continuous images are timed by it
+def find_chessboard(
+    image: MatLike,
+    is_white_sided,
+    is_test=False,
+    board_lock: BoardLock = None,
+    positions_cache: PositionsCache = None,
+    detection_size: int = None,
+    refine_corners: bool = False,
+    timestamp: float = None
+) -> Chessboard:
+    with instrumentation.span("cv.find_chessboard"):
+        chessboard = __find_chessboard(
+            image, is_white_sided, is_test, board_lock, positions_cache, detection_size, refine_corners, timestamp
+        )
+
+    if chessboard is None:
+        instrumentation.count("cv.chessboard_not_found")
+    else:
+        instrumentation.observe_value("cv.dirty_cells", chessboard.dirty_cells)
+    return chessboard
+
+
+def __find_chessboard(
+    image: MatLike,
+    is_white_sided,
+    is_test: bool,
+    board_lock: BoardLock,
+    positions_cache: PositionsCache,
+    detection_size: int,
+    refine_corners: bool,
+    timestamp: float
+) -> Chessboard:
     start = time.time()
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    edges = utils.get_edges(gray=gray, iterations=1)
+    if board_lock is not None and board_lock.is_locked(is_white_sided):
+        with instrumentation.span("cv.board_lock_warp"):
+            wrapped = board_lock.warp(image)
+        if wrapped is not None:
+            instrumentation.count("cv.board_lock_hits")
+            if get_debug_sink().enabled:
+                get_debug_sink().emit("locked_wrapped", wrapped)
+            return create_chessboard(wrapped, board_lock.transform, positions_cache, timestamp)
+        instrumentation.count("cv.board_lock_misses")
+        print("Board lock is lost")
+
+    # cached cells are of the previous warp, the board is found again and may land on other pixels
+    if board_lock is not None and positions_cache is not None:
+        positions_cache.reset()
+
+    scale = None
+    detection_image = image
+    if detection_size is not None and max(image.shape[:2]) > detection_size:
+        with instrumentation.span("cv.downscale"):
+            detection_image, scale = __downscale(image, detection_size)
+
+    # pre-process image
+    with instrumentation.span("cv.get_edges"):
+        gray = cv2.cvtColor(detection_image, cv2.COLOR_BGR2GRAY)
+        edges = utils.get_edges(gray=gray, iterations=1)
     
     # squares
-    contours, _ = cv2.findContours(edges, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-    squares = filter_squares(contours)
+    with instrumentation.span("cv.find_contours"):
+        contours, _ = cv2.findContours(edges, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+    with instrumentation.span("cv.filter_squares"):
+        squares = filter_squares(contours)
     if is_test:
         __add_fake_squares(squares)
-    clustered = cluster_squares(squares)
+    if len(squares) == 0:
+        print("No squares found")
+        return None
+    with instrumentation.span("cv.cluster_squares"):
+        clustered = cluster_squares(squares)
+    instrumentation.observe_value("cv.contours", len(contours))
+    instrumentation.observe_value("cv.squares_found", len(squares))
+    instrumentation.observe_value("cv.board_squares", len(clustered[0]))
     if is_test:
         print(f"Total squares: {len(squares)}")
     print("Found squares:", len(clustered[0]))
 
     # get chessboard
-    rotated_image, rotated_squares = process_rotation(image, clustered[0])
-    chessboard = build_chess_board(rotated_image, rotated_squares, is_white_sided, is_test=is_test)
+    with instrumentation.span("cv.process_rotation"):
+        rotated_squares, rotation = process_rotation(detection_image, clustered[0])
+    if scale is None:
+        chessboard = build_chess_board(image, rotation, rotated_squares, is_white_sided, is_test=is_test, positions_cache=positions_cache, timestamp=timestamp)
+    else:
+        chessboard = __build_scaled_chess_board(
+            image, detection_image, rotated_squares, rotation, scale, is_white_sided, is_test, positions_cache, refine_corners, timestamp
+        )
+
+    if chessboard is not None:
+        if board_lock is not None:
+            board_lock.lock(chessboard.transform, is_white_sided, chessboard.wrapped)
     
     # test
-    if is_test or True:
-        __show_line_rotated_image(rotated_image, rotated_squares)
+    if is_test:
         print(f"{Fore.CYAN}Elapsed time: {time.time() - start}{Fore.RESET}")
-        __show_test_images(image, edges, clustered, chessboard)
+        if chessboard is not None:
+            print(f"Dirty cells: {chessboard.dirty_cells}")
+
+    sink = get_debug_sink()
+    if sink.enabled:
+        __show_line_rotated_image(sink, get_rotated_image(detection_image, rotation), rotated_squares)
+        __show_test_images(sink, image, edges, clustered, chessboard)
 
     return chessboard
 
 
+# board is found in the rotated coordinates of the downscaled image, its corners are mapped back
+# to the original image, so it is resampled only once at full resolution
+def __build_scaled_chess_board(
+    image: MatLike,
+    detection_image: MatLike,
+    rotated_squares: list[Square],
+    rotation: np.ndarray,
+    scale: np.ndarray,
+    is_white_sided,
+    is_test: bool,
+    positions_cache: PositionsCache,
+    refine_corners: bool,
+    timestamp: float
+) -> Chessboard:
+    grid = find_grid(detection_image, rotation, rotated_squares, is_test)
+    if grid is None:
+        return None
+
+    with instrumentation.span("cv.warp"):
+        corners = find_board_corners(grid)
+        corners = cv2.transform(corners[None], cv2.invertAffineTransform(rotation))[0] / scale
+        if refine_corners:
+            with instrumentation.span("cv.refine_corners"):
+                corners = __refine_corners(image, corners, scale)
+        M = cv2.getPerspectiveTransform(np.float32(corners), get_wrapped_corners(is_white_sided))
+        wrapped = cv2.warpPerspective(image, M, (wrapped_size, wrapped_size))
+    if is_test:
+        print(f"Board corners: {Fore.MAGENTA}{corners.tolist()}{Fore.RESET}")
+    return create_chessboard(wrapped, M, positions_cache, timestamp)
+
+
+# returns the image with the longest side of size and its (x, y) scale,
+# fractional INTER_AREA is slow, so it is used for halving only
+def __downscale(image: MatLike, size: int) -> tuple[MatLike, np.ndarray]:
+    h, w = image.shape[:2]
+    k = size / max(h, w)
+    target = (max(1, round(w * k)), max(1, round(h * k)))
+
+    small = image
+    while small.shape[1] >= 2 * target[0] and small.shape[0] >= 2 * target[1]:
+        small = cv2.resize(small, (small.shape[1] // 2, small.shape[0] // 2), interpolation=cv2.INTER_AREA)
+    small = cv2.resize(small, target, interpolation=cv2.INTER_LINEAR)
+    return small, np.float32([target[0] / w, target[1] / h])
+
+
+# corners found on the downscaled image are precise up to the downscale factor,
+# cornerSubPix looks for the exact ones in full resolution patches around them
+def __refine_corners(image: MatLike, corners: np.ndarray, scale: np.ndarray) -> np.ndarray:
+    h, w = image.shape[:2]
+    win = int(min(max_refine_window, max(2, np.ceil(refine_window_per_scale / scale.min()))))
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 20, 0.05)
+
+    refined = corners.copy()
+    for i, (x, y) in enumerate(corners):
+        x_0, y_0 = int(x) - 2 * win, int(y) - 2 * win
+        x_1, y_1 = int(x) + 2 * win + 1, int(y) + 2 * win + 1
+        if x_0 < 0 or y_0 < 0 or x_1 > w or y_1 > h:
+            continue
+        patch = cv2.cvtColor(image[y_0:y_1, x_0:x_1], cv2.COLOR_BGR2GRAY)
+        point = np.float32([[[x - x_0, y - y_0]]])
+        cv2.cornerSubPix(patch, point, (win, win), (-1, -1), criteria)
+        new_x, new_y = point[0, 0] + (x_0, y_0)
+        # board's outer corners are not always real corners, far jumps are not trusted
+        if abs(new_x - x) <= win and abs(new_y - y) <= win:
+            refined[i] = (new_x, new_y)
+    return refined
+
+
 def __show_test_images(
+    sink: DebugSink,
     image,
     edges,
     squares: list[list[Square]],
     chessboard: Chessboard
 ) -> None:
-    # utils.show_image(edges)
+    sink.emit("edges", edges)
     # print(f"Found squares: {squares}")
     
     # line_img = image.copy()
@@ -56,7 +226,7 @@ def __show_test_images(
     # utils.show_image(line_img)
     
     if chessboard is not None:
-        utils.show_image(chessboard.wrapped)
+        sink.emit("wrapped", chessboard.wrapped)
         wrapped = chessboard.wrapped.copy()
         h, w , _= wrapped.shape
         for i in range(0, 7):
@@ -73,12 +243,12 @@ def __show_test_images(
                 s = f'{position.name[0]}, ({i}, {j})'
                 cv2.putText(wrapped, s, p, cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2, 2)
 
-        utils.show_image(wrapped)
+        sink.emit("positions", wrapped)
 
-def __show_line_rotated_image(rotated_image, rotated_squares):
+def __show_line_rotated_image(sink: DebugSink, rotated_image, rotated_squares):
     line_rotated_image = rotated_image.copy()
     __draw_squares(line_rotated_image, rotated_squares, (0, 255, 0))
-    utils.show_image(line_rotated_image)
+    sink.emit("rotated_squares", line_rotated_image)
 
 
 def __add_fake_squares(squares: list[Square]):
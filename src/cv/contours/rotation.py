@@ -5,57 +5,72 @@ import numpy as np
 from src.cv.contours.square import Square
 
 
-def process_rotation(image: MatLike, squares: list[Square]) -> tuple[MatLike, list[Square]]:
+# image isn't resampled here, M is folded into the next warps of the original image
+def process_rotation(image: MatLike, squares: list[Square]) -> tuple[list[Square], np.ndarray]:
     horizontal_angle = np.mean([s.calc_h_angle() for s in squares])
     angle = horizontal_angle
     # print(f"Horizontal angle = {horizontal_angle}, rotate angle = {np.rad2deg(angle)}, squares count = {len(squares)}")
 
     h, w = image.shape[:2]
     center = (w//2, h//2)
-    rotated_image = __rotate_image(image, angle, center=center)
+    M = cv2.getRotationMatrix2D(center, np.rad2deg(angle), 1.0)
     rotated_squares = __rotate_squares(squares, angle, center=center)
 
-    return rotated_image, rotated_squares
+    return rotated_squares, M
 
 
-def __rotate_image(image: MatLike, angle: float, scale=1.0, center=(0, 0)):
+# x_0:x_1, y_0:y_1 part of the image rotated by M, only this part is resampled,
+# color_conversion is applied before the warp to the source pixels of the part only
+def get_rotated_region(
+    image: MatLike,
+    M: np.ndarray,
+    x_0: int, y_0: int, x_1: int, y_1: int,
+    color_conversion: int = None
+) -> MatLike:
     h, w = image.shape[:2]
-    
-    M = cv2.getRotationMatrix2D(center, np.rad2deg(angle), scale)
-    
-    rotated = cv2.warpAffine(image, M, (w, h))
-    return rotated
+    region = np.float32([[[x_0, y_0], [x_1, y_0], [x_1, y_1], [x_0, y_1]]])
+    source = cv2.transform(region, cv2.invertAffineTransform(M))[0]
+    # one pixel margin for the interpolation
+    s_x_0, s_y_0 = np.maximum(np.floor(source.min(axis=0)).astype(int) - 1, 0)
+    s_x_1, s_y_1 = np.minimum(np.ceil(source.max(axis=0)).astype(int) + 2, (w, h))
 
+    source_image = image[s_y_0:s_y_1, s_x_0:s_x_1]
+    if color_conversion is not None:
+        source_image = cv2.cvtColor(source_image, color_conversion)
 
-def __rotate_squares(squares: list[Square], angle: float, center=None):
-    rotated_squares = []
+    shifted = M.copy()
+    shifted[:, 2] += M[:, :2] @ (s_x_0, s_y_0) - (x_0, y_0)
+    return cv2.warpAffine(source_image, shifted, (x_1 - x_0, y_1 - y_0))
+
+
+def get_rotated_image(image: MatLike, M: np.ndarray) -> MatLike:
+    h, w = image.shape[:2]
+    return get_rotated_region(image, M, 0, 0, w, h)
 
+
+def __rotate_squares(squares: list[Square], angle: float, center=None):
     rot_matrix = np.array([
         [np.cos(angle), -np.sin(angle)],
         [np.sin(angle), np.cos(angle)]
     ])
-    
-    for square in squares:
-        corners = square.approx
-        if center is not None:
-            corners = corners - center
-    
-        corners = np.dot(corners, rot_matrix)
-        if center is not None:
-            corners += center
-
-        corners = corners.astype(np.int32)
-        
-        x, y = corners[0]
-        rotated_square = Square(
-            x=x,
-            y=y,
+
+    # (n, 4, 2) corners of all squares are rotated at once
+    corners = np.stack([square.approx for square in squares])
+    if center is not None:
+        corners = corners - center
+    corners = corners @ rot_matrix
+    if center is not None:
+        corners += center
+    corners = corners.astype(np.int32)
+
+    return [
+        Square(
+            x=c[0][0],
+            y=c[0][1],
             w=square.w,  # Note: width/height might need recalculation
             h=square.h,
             area=square.area,
-            approx=corners
+            approx=c
         )
-        
-        rotated_squares.append(rotated_square)
-    
-    return rotated_squares
+        for square, c in zip(squares, corners)
+    ]
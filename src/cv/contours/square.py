@@ -4,13 +4,18 @@ from cv2.typing import MatLike
 from dataclasses import dataclass
 from typing import Final
 
-from src.cv.utils import calc_points_dist, calc_angle
+from src import instrumentation
+from src.cv.utils import calc_angle
 
 rate: Final[float] = 0.1
 square_area_percentage_threshold = 1 + rate
 square_area_percentage_threshold_groups_merge = (1 + rate) / (1 - rate)
 
-max_clustering_count = 6
+min_square_area: Final[float] = 300
+min_aspect_ratio: Final[float] = 0.85
+max_aspect_ratio: Final[float] = 1.15
+# squares in perspective are still close to squares, so their bounding rects are
+max_bounding_aspect_ratio: Final[float] = 2.0
 
 
 @dataclass
@@ -34,113 +39,99 @@ class Square:
 
 
 def filter_squares(contours: MatLike) -> list[Square]:
-    squares = []
-
+    candidates = []
     for cnt in contours:
-        approx = cv2.approxPolyDP(cnt, 0.02 * cv2.arcLength(cnt, True), True)
-
-        if len(approx) != 4:
-            continue
-        if not cv2.isContourConvex(approx):
+        # cheap checks before the polygon approximation, most of the contours are small noise
+        if len(cnt) < 4:
             continue
-
-        area = cv2.contourArea(approx)
-        if area < 300:
-            continue
-
-        approx = approx.reshape(4, 2)
-        points, w, h = __recompose_square_points(approx)
-
-        aspect_ratio = float(w) / h
-        if aspect_ratio < 0.85 or 1.15 < aspect_ratio:
+        _, _, w, h = cv2.boundingRect(cnt)
+        if w * h < min_square_area or max(w, h) > max_bounding_aspect_ratio * min(w, h):
             continue
 
-        x, y = points[0]
+        approx = cv2.approxPolyDP(cnt, 0.02 * cv2.arcLength(cnt, True), True)
+        if len(approx) == 4:
+            candidates.append(approx.reshape(4, 2))
 
-        squares.append(Square(x, y, w, h, area, points))
-    return squares
+    if len(candidates) == 0:
+        return []
+    points = np.stack(candidates)
 
+    is_square = __is_convex(points)
+    areas = __calc_areas(points)
+    is_square &= areas >= min_square_area
 
+    points, areas = points[is_square], areas[is_square]
+    points, w, h = __recompose_squares_points(points)
 
-def cluster_squares(squares: list[Square]) -> list[list[Square]]:
-    result = [squares]
-    counter = 1
-    while not __check_area_threshold_in_group(result[0]) and (len(result[0]) >= 3) and (counter <= max_clustering_count):
-        counter += 1
-        clustered = __cluster_group(result[0])
-        result = [*clustered, *result[1:]]
-    return result
+    aspect_ratio = w / h
+    is_square = (min_aspect_ratio <= aspect_ratio) & (aspect_ratio <= max_aspect_ratio)
 
+    return [
+        Square(int(p[0, 0]), int(p[0, 1]), float(w_i), float(h_i), float(area), p)
+        for p, w_i, h_i, area in zip(points[is_square], w[is_square], h[is_square], areas[is_square])
+    ]
 
-def __check_area_threshold_in_group(squares: list[Square]) -> bool:
-    areas = [square.w*square.h for square in squares]
-    avg = np.mean(areas)
 
-    for area in areas:
-        if not __check_threshold(area, avg, square_area_percentage_threshold):
-            return False
-    return True
 
+# the chessboard group goes first: the biggest one where all areas are close to their mean,
+# other squares are split by gaps between their sorted areas, bigger squares go first
+def cluster_squares(squares: list[Square]) -> list[list[Square]]:
+    if len(squares) < 3:
+        return [squares]
 
-def __check_threshold(area1, area2, threshold) -> bool:
-    return max(area1, area2) / min(area1, area2) < threshold**2
+    areas = np.array([square.w*square.h for square in squares], dtype=np.float64)
+    order = np.argsort(areas, kind='stable')
+    log_areas = np.log(areas[order])
 
+    start, end = __find_densest_window(log_areas, 2 * np.log(square_area_percentage_threshold**2))
+    rest = np.concatenate([order[:start], order[end:]])
+    # squares keep their original order inside the groups
+    result = [[squares[i] for i in np.sort(order[start:end])]]
 
-def __cluster_group(squares: list[Square]) -> list[list[Square]]:
-    sides = np.zeros((len(squares), 2), dtype=np.float32)
-    for i, square in enumerate(squares):
-        sides[i, 0] = square.w 
-        sides[i, 1] = square.h
+    # merged groups threshold separates the other groups
+    splits = np.flatnonzero(np.diff(np.log(areas[rest])) > np.log(square_area_percentage_threshold_groups_merge**2)) + 1
+    for group in reversed(np.split(rest, splits)):
+        if len(group) != 0:
+            result.append([squares[i] for i in np.sort(group)])
 
-    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 10, 1.0)
-    ret, labels, average_vals = cv2.kmeans(sides, min(3, len(sides)), None, criteria, 10, cv2.KMEANS_RANDOM_CENTERS)
-    if not ret:
-        print("Not successful squares kmeans search")
-        return [squares]
+    instrumentation.observe_value("cv.square_groups", len(result))
+    return result
 
-    result = [(average_vals[i], []) for i in range(len(average_vals))]
-    for i, val in enumerate(labels.ravel()):
-        result[val][1].append(squares[i])
-    result = sorted(result, key=lambda x: len(x[1]), reverse=True)
-    # print(
-    #     ', '.join([str(i + 1) + ': ' + str(len(result[i])) for i in range(len(result))]),
-    #     f", center = {average_vals}"
-    # )
 
-    return __merge_similar_groups([item[1] for item in result], [item[0] for item in result])
+# returns [start, end) of the window of the sorted values no wider than width with the most values,
+# the one with the biggest values is taken from the equal ones
+def __find_densest_window(values: np.ndarray, width: float) -> tuple[int, int]:
+    ends = np.searchsorted(values, values + width, side='right')
+    counts = ends - np.arange(len(values))
+    start = len(counts) - 1 - int(np.argmax(counts[::-1]))
+    return start, int(ends[start])
 
 
-def __merge_similar_groups(groups: list[list[Square]], average_vals) -> list[list[Square]]:
-    areas = [center[0]*center[1] for center in average_vals]
+def __is_convex(points: np.ndarray) -> np.ndarray:
+    edges = np.roll(points, -1, axis=1) - points
+    next_edges = np.roll(edges, -1, axis=1)
+    cross = edges[:, :, 0] * next_edges[:, :, 1] - edges[:, :, 1] * next_edges[:, :, 0]
+    return np.all(cross > 0, axis=1) | np.all(cross < 0, axis=1)
 
-    # assume that most of the squares are on chessboard
-    result = [groups[0]]
-    for i in range(1, len(groups)):
-        if __check_threshold(areas[0], areas[i], square_area_percentage_threshold_groups_merge):
-            result[0].extend(groups[i])
-        else:
-            result.append(groups[i])
-    return result
 
+def __calc_areas(points: np.ndarray) -> np.ndarray:
+    x, y = points[:, :, 0].astype(np.float64), points[:, :, 1].astype(np.float64)
+    return np.abs(np.sum(x * np.roll(y, -1, axis=1) - np.roll(x, -1, axis=1) * y, axis=1)) / 2
 
-# points, w, h
-def __recompose_square_points(points):
-    r = np.zeros_like(points)
 
-    x_c = np.mean(points[:, 0])
-    y_c = np.mean(points[:, 1])
+# points are ordered as top left, bottom left, bottom right, top right
+# returns points, w, h
+def __recompose_squares_points(points: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    d = points - points.mean(axis=1, keepdims=True)
+    angles = np.arctan2(d[:, :, 1], d[:, :, 0])
+    # counted counterclockwise on the screen (up, left, down, right) from the upward direction,
+    # so top left point goes first
+    order = np.argsort(np.mod(-np.pi / 2 - angles, 2 * np.pi), axis=1, kind='stable')
+    r = np.take_along_axis(points, order[:, :, None], axis=1)
 
-    for point in points:
-        x, y = point
-        if x < x_c and y < y_c:
-            r[0] = point
-        elif x < x_c and y >= y_c:
-            r[1] = point
-        elif x >= x_c and y >= y_c:
-            r[2] = point
-        else:
-            r[3] = point
+    def dist(i, j):
+        return np.linalg.norm((r[:, i] - r[:, j]).astype(np.float64), axis=1)
 
-    w = (calc_points_dist(r[3], r[0]) + calc_points_dist(r[2], r[1])) / 2
-    h = (calc_points_dist(r[1], r[0]) + calc_points_dist(r[3], r[2])) / 2
+    w = (dist(3, 0) + dist(2, 1)) / 2
+    h = (dist(1, 0) + dist(3, 2)) / 2
     return r, w, h
@@ -0,0 +1,77 @@
+import queue
+import threading
+from pathlib import Path
+from typing import Final
+
+import cv2
+from cv2.typing import MatLike
+
+from src.cv import utils
+
+
+max_queued_images: Final[int] = 64
+
+
+# no-op sink, callers check enabled before drawing anything, so it costs nothing
+class DebugSink:
+    enabled: bool = False
+
+    # image must not be changed by the caller after it has been emitted
+    def emit(self, tag: str, image: MatLike) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class DirectoryDebugSink(DebugSink):
+    enabled = True
+    directory: Path
+
+    def __init__(self, directory: str | Path):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        self.__counter = 0
+        self.__queue: queue.Queue = queue.Queue(maxsize=max_queued_images)
+        self.__thread = threading.Thread(target=self.__run, name="debug-sink", daemon=True)
+        self.__thread.start()
+
+    def emit(self, tag: str, image: MatLike) -> None:
+        self.__counter += 1
+        try:
+            self.__queue.put_nowait((f"{self.__counter:06d}_{tag}.png", image))
+        except queue.Full:
+            # the pipeline must not wait for the disk
+            pass
+
+    def close(self) -> None:
+        self.__queue.put(None)
+        self.__thread.join()
+
+    def __run(self) -> None:
+        while True:
+            item = self.__queue.get()
+            if item is None:
+                return
+            name, image = item
+            cv2.imwrite(str(self.directory / name), image)
+
+
+class WindowDebugSink(DebugSink):
+    enabled = True
+
+    def emit(self, tag: str, image: MatLike) -> None:
+        utils.show_image(image, tag)
+
+
+__debug_sink: DebugSink = DebugSink()
+
+
+def get_debug_sink() -> DebugSink:
+    return __debug_sink
+
+
+def set_debug_sink(sink: DebugSink) -> None:
+    global __debug_sink
+    __debug_sink = sink
@@ -0,0 +1,192 @@
+import contextlib
+import json
+import re
+import threading
+import time
+from collections import deque
+from pathlib import Path
+from typing import Final
+
+import numpy as np
+
+
+# latency buckets in seconds
+latency_buckets: Final[tuple[float]] = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100)
+# values (counts) buckets, contours are counted in thousands
+value_buckets: Final[tuple[float]] = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000)
+# last values which are used for percentiles
+recent_values_count: Final[int] = 1024
+
+
+class Histogram:
+    count: int
+    sum: float
+    bounds: tuple[float]
+
+    def __init__(self, bounds: tuple[float] = latency_buckets):
+        self.bounds = bounds
+        self.count = 0
+        self.sum = 0.0
+        self.min = float('inf')
+        self.max = float('-inf')
+        self.bucket_counts = [0] * (len(bounds) + 1)
+        self.recent = deque(maxlen=recent_values_count)
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        i = 0
+        while i < len(self.bounds) and value > self.bounds[i]:
+            i += 1
+        self.bucket_counts[i] += 1
+        self.recent.append(value)
+
+    def to_dict(self) -> dict:
+        if self.count == 0:
+            return {"count": 0}
+        recent = np.array(self.recent)
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count,
+            "min": self.min,
+            "max": self.max,
+            "p50": float(np.percentile(recent, 50)),
+            "p95": float(np.percentile(recent, 95)),
+        }
+
+
+class __Span:
+    def __init__(self, name: str):
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self) -> '__Span':
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args) -> None:
+        observe(self.name, time.perf_counter() - self.start)
+
+
+__enabled = False
+__lock = threading.Lock()
+__counters: dict[str, float] = {}
+__histograms: dict[str, Histogram] = {}
+__null_span = contextlib.nullcontext()
+
+
+def enable(enabled: bool = True) -> None:
+    global __enabled
+    __enabled = enabled
+
+
+def is_enabled() -> bool:
+    return __enabled
+
+
+# with span("name"): ... records the block duration in seconds into the "name" histogram
+def span(name: str):
+    if not __enabled:
+        return __null_span
+    return __Span(name)
+
+
+def count(name: str, value: float = 1) -> None:
+    if not __enabled:
+        return
+    with __lock:
+        __counters[name] = __counters.get(name, 0) + value
+
+
+# durations in seconds by default, bounds are taken by the first observation of the name
+def observe(name: str, value: float, bounds: tuple[float] = latency_buckets) -> None:
+    if not __enabled:
+        return
+    with __lock:
+        histogram = __histograms.get(name)
+        if histogram is None:
+            histogram = __histograms[name] = Histogram(bounds)
+        histogram.observe(value)
+
+
+# counts and other values which aren't durations
+def observe_value(name: str, value: float) -> None:
+    observe(name, value, value_buckets)
+
+
+def get_recent_values(name: str) -> list[float]:
+    with __lock:
+        histogram = __histograms.get(name)
+        return [] if histogram is None else list(histogram.recent)
+
+
+def reset() -> None:
+    with __lock:
+        __counters.clear()
+        __histograms.clear()
+
+
+def snapshot() -> dict:
+    with __lock:
+        return {
+            "timestamp": time.time(),
+            "counters": dict(__counters),
+            "histograms": {name: h.to_dict() for name, h in __histograms.items()},
+        }
+
+
+def dump_json(path: str | Path) -> None:
+    Path(path).write_text(json.dumps(snapshot(), indent=2))
+
+
+def dump_prometheus(path: str | Path, prefix: str = "chess_bot") -> None:
+    lines = []
+    with __lock:
+        for name, value in sorted(__counters.items()):
+            metric = __metric_name(prefix, name) + "_total"
+            lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric} {value}")
+
+        for name, h in sorted(__histograms.items()):
+            metric = __metric_name(prefix, name)
+            lines.append(f"# TYPE {metric} histogram")
+            cumulative = 0
+            for bound, bucket_count in zip(h.bounds, h.bucket_counts):
+                cumulative += bucket_count
+                lines.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+            lines.append(f'{metric}_bucket{{le="+Inf"}} {h.count}')
+            lines.append(f"{metric}_sum {h.sum}")
+            lines.append(f"{metric}_count {h.count}")
+
+    # written by rename, so the scraper never reads a half written file
+    path = Path(path)
+    tmp_path = path.with_name(path.name + ".tmp")
+    tmp_path.write_text("\n".join(lines) + "\n")
+    tmp_path.replace(path)
+
+
+# .prom files are written in the Prometheus text format, others as JSON
+def dump(path: str | Path) -> None:
+    if str(path).endswith(".prom"):
+        dump_prometheus(path)
+    else:
+        dump_json(path)
+
+
+# dumps snapshots every interval seconds until the returned event is set
+def start_periodic_dump(path: str | Path, interval: float = 10.0) -> threading.Event:
+    stopped = threading.Event()
+
+    def run():
+        while not stopped.wait(interval):
+            dump(path)
+
+    threading.Thread(target=run, name="metrics-dump", daemon=True).start()
+    return stopped
+
+
+def __metric_name(prefix: str, name: str) -> str:
+    return re.sub(r'[^a-zA-Z0-9_:]', '_', f"{prefix}_{name}")
@@ -1,15 +1,123 @@
 from colorama import Fore
-from stockfish import Stockfish
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable
 import argparse
+import sys
+import time
 
-from src.camera import select_camera
+from src import instrumentation
+from src.camera import FrameSource, RecordingSource, VideoFileSource, select_camera
+from src.cv.chessboard.board_lock import BoardLock
 from src.cv.chessboard.chessboard import Chessboard
-from src.cv.chessboard_find import find_chessboard
-from src.step_processing.process_step import PlayingSide, StepProcessor
+from src.cv.chessboard.cell_classifier import CellClassifier, load_classifier
+from src.cv.chessboard.chessboard_position_check import PositionsCache
+from src.cv.chessboard_find import find_chessboard, warm_up
+from src.cv.debug import DebugSink, DirectoryDebugSink, WindowDebugSink, set_debug_sink
+from src.recording import FrameRecorder, FrameRecording, RecordedInput, ReplayedInput, default_max_size
+from src.step_processing.analysis_cache import AnalysisCache, default_max_entries, random_move_candidates
+from src.step_processing.opening_book import OpeningBook
+from src.step_processing.process_step import PlayingSide, StepProcessor, default_movetime
+from src.step_processing.uci_engine import UciEngine
+from src.stream import FrameGrabber, MotionGate, PositionVoter, idle_interval
 
 
-def main(elo: int):
-    capture = select_camera()
+def main(
+    elo: int,
+    engine_path: str = '/usr/games/stockfish',
+    movetime: int = default_movetime,
+    ponder: bool = True,
+    analysis_cache_path: str = None,
+    analysis_cache_size: int = default_max_entries,
+    random_moves: bool = False,
+    book_path: str = None,
+    stream: bool = False,
+    stable_frames: int = 5,
+    min_votes: int = None,
+    motion_gate: bool = False,
+    lock_board: bool = False,
+    detection_size: int = None,
+    refine_corners: bool = False,
+    source: FrameSource = None,
+    read_input: Callable[[str], str] = input,
+    recorder: FrameRecorder = None,
+    use_camera_cache: bool = True,
+    cell_model_path: str = None
+):
+    if recorder is not None:
+        read_input = RecordedInput(recorder, read_input)
+
+    options = {"UCI_LimitStrength": "true", "UCI_Elo": elo}
+    if random_moves:
+        options["MultiPV"] = random_move_candidates
+    engine = UciEngine(engine_path, options)
+
+    # engine and the detection warm up while the camera and the side are being selected,
+    # one after another, so the warm-up doesn't delay the first bot's move.
+    # The opening is played by the book, the engine is started when the bot leaves it
+    startup = ThreadPoolExecutor(max_workers=1, thread_name_prefix="startup")
+    engine_started = startup.submit(engine.start) if book_path is None else None
+    startup.submit(warm_up)
+    startup.shutdown(wait=False)
+
+    analysis_cache = AnalysisCache(analysis_cache_path, analysis_cache_size) if analysis_cache_path is not None else None
+    opening_book = OpeningBook(book_path) if book_path is not None else None
+    classifier = load_classifier(cell_model_path) if cell_model_path is not None else None
+    try:
+        __play(
+            engine=engine,
+            movetime=movetime,
+            ponder=ponder,
+            analysis_cache=analysis_cache,
+            random_moves=random_moves,
+            opening_book=opening_book,
+            stream=stream,
+            stable_frames=stable_frames,
+            min_votes=min_votes,
+            motion_gate=motion_gate,
+            lock_board=lock_board,
+            detection_size=detection_size,
+            refine_corners=refine_corners,
+            source=source,
+            read_input=read_input,
+            recorder=recorder,
+            engine_started=engine_started,
+            use_camera_cache=use_camera_cache,
+            classifier=classifier
+        )
+    except EOFError:
+        print(f"{Fore.MAGENTA}Inputs have ended{Fore.RESET}")
+    finally:
+        # closing doesn't race with the starting process
+        startup.shutdown(wait=True)
+        engine.close()
+        if analysis_cache is not None:
+            analysis_cache.close()
+
+
+# many settings of the same types, so they are passed by names only
+def __play(
+    *,
+    engine: UciEngine,
+    movetime: int,
+    ponder: bool,
+    analysis_cache: AnalysisCache,
+    random_moves: bool,
+    opening_book: OpeningBook,
+    stream: bool,
+    stable_frames: int,
+    min_votes: int,
+    motion_gate: bool,
+    lock_board: bool,
+    detection_size: int,
+    refine_corners: bool,
+    source: FrameSource,
+    read_input: Callable[[str], str],
+    recorder: FrameRecorder,
+    engine_started: Future | None,
+    use_camera_cache: bool,
+    classifier: CellClassifier
+):
+    capture = source if source is not None else select_camera(use_camera_cache)
     if capture is None:
         print(f"{Fore.RED}Exception: Can't start capture{Fore.RESET}")
         return
@@ -17,50 +125,247 @@ def main(elo: int):
     player_side: str = None
     print("Select your side (w/b)")
     while player_side is None:
-        s = input("-> ")
+        s = read_input("-> ")
         if s == 'w' or s == 'b':
             player_side = s
 
-    stockfish = Stockfish('/usr/games/stockfish')
-    stockfish.set_elo_rating(elo)
-    stepProcessor = StepProcessor(PlayingSide.WHITE if player_side == 'b' else PlayingSide.BLACK, stockfish)
+    try:
+        if engine_started is not None:
+            engine_started.result()
+    except Exception as e:
+        print(f"{Fore.RED}Exception: Can't start engine {engine.path}: {e}{Fore.RESET}")
+        capture.release()
+        return
+
+    stepProcessor = StepProcessor(PlayingSide.WHITE if player_side == 'b' else PlayingSide.BLACK, engine, movetime, ponder, analysis_cache, random_moves, opening_book, read_input)
 
     if stepProcessor.bot_playing_side == PlayingSide.WHITE:
         stepProcessor.make_bots_move()
 
     stepProcessor.current_fen.print()
 
+    board_lock = BoardLock() if lock_board else None
+    positions_cache = PositionsCache(classifier, detect_occlusions=stream)
+    if stream:
+        __run_streaming(
+            capture,
+            stepProcessor,
+            stable_frames=stable_frames,
+            min_votes=min_votes,
+            motion_gate=motion_gate,
+            board_lock=board_lock,
+            positions_cache=positions_cache,
+            detection_size=detection_size,
+            refine_corners=refine_corners,
+            recorder=recorder
+        )
+    else:
+        __run_interactive(
+            capture,
+            stepProcessor,
+            board_lock=board_lock,
+            positions_cache=positions_cache,
+            detection_size=detection_size,
+            refine_corners=refine_corners,
+            read_input=read_input,
+            recorder=recorder
+        )
+
+    capture.release()
+
+
+def __run_interactive(capture: FrameSource, stepProcessor: StepProcessor, *, board_lock: BoardLock, positions_cache: PositionsCache, detection_size: int, refine_corners: bool, read_input: Callable[[str], str], recorder: FrameRecorder):
     while True:
-        s = input(f"""{Fore.GREEN}Print {Fore.MAGENTA}q{Fore.GREEN} to {Fore.MAGENTA}end game{Fore.GREEN} or {Fore.MAGENTA}any{Fore.GREEN} other letter when your move is made!{Fore.RESET}""")
+        s = read_input(f"""{Fore.GREEN}Print {Fore.MAGENTA}q{Fore.GREEN} to {Fore.MAGENTA}end game{Fore.GREEN} or {Fore.MAGENTA}any{Fore.GREEN} other letter when your move is made!{Fore.RESET}""")
         if s == 'q':
             return
         
+        started_at = time.perf_counter()
         ret, frame = capture.read()
         if not ret:
             print(f"{Fore.RED}Exception: Can't read a picture{Fore.RESET}")
+            continue
+        if recorder is not None:
+            recorder.write_frame(frame, capture.timestamp)
         
         ## chessboard
-        new_chess_board: Chessboard = find_chessboard(frame, is_white_sided=stepProcessor.bot_playing_side==PlayingSide.WHITE, is_test=False)
+        new_chess_board: Chessboard = find_chessboard(frame, is_white_sided=stepProcessor.bot_playing_side==PlayingSide.WHITE, is_test=False, board_lock=board_lock, positions_cache=positions_cache, detection_size=detection_size, refine_corners=refine_corners)
         if new_chess_board is None:
             print(f"{Fore.RED}Exception: Can't find chessboard{Fore.RESET}")
             continue
 
-        ## process step
-        if not stepProcessor.process_enemy_step(new_chess_board):
-            continue
-        if stepProcessor.is_game_ended(False):
+        if __process_step(stepProcessor, new_chess_board, positions_cache, interactive=True, started_at=started_at):
             break
 
-        if not stepProcessor.make_bots_move():
-            continue
-        if stepProcessor.is_game_ended(True):
-            break
-        
-    capture.release()
+
+def __run_streaming(capture: FrameSource, stepProcessor: StepProcessor, *, stable_frames: int, min_votes: int, motion_gate: bool, board_lock: BoardLock, positions_cache: PositionsCache, detection_size: int, refine_corners: bool, recorder: FrameRecorder):
+    print(f"{Fore.GREEN}Streaming mode: make your move, it will be detected automatically. Press {Fore.MAGENTA}Ctrl+C{Fore.GREEN} to {Fore.MAGENTA}end game{Fore.RESET}")
+    voter = PositionVoter(stable_frames, min_votes)
+    # the voter needs min_votes frames, the rest of the window is for the frames it disagrees with
+    gate = MotionGate(2 * stable_frames) if motion_gate else None
+
+    frames = __read_frames(capture, gate, recorder)
+    is_gated = False
+    try:
+        for timestamp, frame in frames:
+            if gate is not None and not gate.update(frame):
+                instrumentation.count("stream.frames_gated")
+                is_gated = True
+                continue
+            # votes of the frames before the motion are stale
+            if is_gated:
+                voter.reset()
+                is_gated = False
+
+            new_chess_board: Chessboard = find_chessboard(frame, is_white_sided=stepProcessor.bot_playing_side==PlayingSide.WHITE, is_test=False, board_lock=board_lock, positions_cache=positions_cache, detection_size=detection_size, refine_corners=refine_corners, timestamp=timestamp)
+            stable_board = voter.update(new_chess_board)
+            if gate is not None and voter.is_clear:
+                gate.close()
+            if stable_board is None or not stepProcessor.is_board_changed(stable_board):
+                continue
+
+            moves_count = len(stepProcessor.moves)
+            is_ended = __process_step(stepProcessor, stable_board, positions_cache, interactive=False, started_at=time.perf_counter())
+            # a board which isn't a move stays emitted, so it's processed again only after it has changed
+            if len(stepProcessor.moves) != moves_count:
+                voter.reset()
+            if is_ended:
+                break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        frames.close()
+
+
+# yields frames with their times, live frames are taken by the grabber, the newest one each time,
+# other sources give every frame as fast as it's processed. The grabber polls the live source rarely while the gate is idle.
+# The yielded frames are recorded, the ones the grabber drops aren't, so the replay reads the same frames
+def __read_frames(capture: FrameSource, gate: MotionGate = None, recorder: FrameRecorder = None):
+    if not capture.is_live:
+        while True:
+            ret, frame = capture.read()
+            if not ret:
+                return
+            timestamp = capture.timestamp if capture.timestamp is not None else time.time()
+            if recorder is not None:
+                recorder.write_frame(frame, timestamp)
+            yield timestamp, frame
+
+    grabber = FrameGrabber(capture).start()
+    frame_id = 0
+    try:
+        while grabber.is_running():
+            frame_id, frame, timestamp = grabber.read_latest(frame_id)
+            if frame is not None:
+                if recorder is not None:
+                    recorder.write_frame(frame, timestamp)
+                yield timestamp, frame
+            grabber.interval = idle_interval if gate is not None and gate.is_idle else 0
+    finally:
+        grabber.stop()
+
+
+# returns True when the game has ended, started_at is the keypress (or stable board) time
+def __process_step(stepProcessor: StepProcessor, new_chess_board: Chessboard, positions_cache: PositionsCache, interactive: bool, started_at: float) -> bool:
+    if not stepProcessor.process_enemy_step(new_chess_board, interactive=interactive):
+        # a misclassified cell would stay cached until its image changes, so all cells are classified again
+        positions_cache.reset()
+        return False
+    if stepProcessor.is_game_ended(False):
+        return True
+
+    if not stepProcessor.make_bots_move():
+        return False
+    instrumentation.observe("step.keypress_to_bot_move", time.perf_counter() - started_at)
+    if stepProcessor.is_game_ended(True):
+        return True
+    return False
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='CV && Stockfish based chess bot')
     parser.add_argument('--elo', type=int, default=1350, help="Bot's elo")
+    parser.add_argument('--engine', type=str, default='/usr/games/stockfish', help="Path to the Stockfish binary")
+    parser.add_argument('--movetime', type=int, default=default_movetime, help="Bot's search time in milliseconds")
+    parser.add_argument('--no-ponder', action='store_true', help="Don't let the engine think during the player's turn")
+    parser.add_argument('--analysis-cache', type=str, default=None, help="SQLite file where the engine results are kept between games")
+    parser.add_argument('--analysis-cache-size', type=int, default=default_max_entries, help="Positions kept in the analysis cache")
+    parser.add_argument('--random-moves', action='store_true', help="Pick among the engine's candidate moves close to the best one")
+    parser.add_argument('--book', type=str, default=None, help="Polyglot .bin opening book, the bot plays its moves before searching")
+    parser.add_argument('--stream', action='store_true', help="Detect moves from the camera stream without keypresses")
+    parser.add_argument('--stable-frames', type=int, default=5, help="Last frames which vote for the cells positions in streaming mode")
+    parser.add_argument('--min-votes', type=int, default=None, help="Votes every cell needs to accept a board in streaming mode, 60%% of --stable-frames by default")
+    parser.add_argument('--motion-gate', action='store_true', help="Detect the board in streaming mode only after the motion in the frame has settled, poll the camera rarely while nothing moves")
+    parser.add_argument('--board-lock', action='store_true', help="Reuse the found board position on the next frames while it stays in place")
+    parser.add_argument('--debug', choices=['none', 'dir', 'window'], default=None, help="Where to send debug images, by default windows are shown in the interactive mode only")
+    parser.add_argument('--debug-dir', type=str, default='debug_output', help="Directory for debug images when --debug=dir")
+    parser.add_argument('--detection-size', type=int, default=1280, help="Longest side of the downscaled frame copy where the board is searched, 0 to search in full resolution")
+    parser.add_argument('--refine-corners', action='store_true', help="Refine the board corners found on the downscaled frame in full resolution")
+    parser.add_argument('--select-camera', action='store_true', help="Ask for the camera even if the last selected one is available")
+    parser.add_argument('--video', type=str, default=None, help="Play from a video file instead of a camera")
+    parser.add_argument('--video-step', type=int, default=1, help="Use every n-th frame of the video file")
+    parser.add_argument('--record', type=str, default=None, help="Directory where the frames and inputs of the game are recorded")
+    parser.add_argument('--record-size', type=int, default=default_max_size // 2**20, help="Megabytes of the last frames kept in the recording, a recording which has overwritten its first frames can't be replayed")
+    parser.add_argument('--cell-model', type=str, default=None, help="Pickled cells classifier trained by src.cv.chessboard.cell_classifier, rule based classification by default. Pickle runs code on loading, use trusted files only")
+    parser.add_argument('--replay', type=str, default=None, help="Directory of a recorded game to play again with its inputs")
+    parser.add_argument('--metrics', type=str, default=None, help="Enable instrumentation and dump it to this file (.prom for Prometheus text format, JSON otherwise)")
+    parser.add_argument('--metrics-interval', type=float, default=10.0, help="Seconds between metrics dumps")
     args = parser.parse_args()
-    
-    main(elo=args.elo)
+
+    metrics_stopped = None
+    if args.metrics is not None:
+        instrumentation.enable()
+        metrics_stopped = instrumentation.start_periodic_dump(args.metrics, args.metrics_interval)
+
+    debug = args.debug if args.debug is not None else ('none' if args.stream else 'window')
+    if debug == 'dir':
+        sink = DirectoryDebugSink(args.debug_dir)
+    elif debug == 'window':
+        sink = WindowDebugSink()
+    else:
+        sink = DebugSink()
+    set_debug_sink(sink)
+
+    source, read_input = None, input
+    if args.replay is not None:
+        recording = FrameRecording(args.replay)
+        if recording.is_wrapped():
+            print(f"{Fore.RED}Exception: The recording has kept only the last {len(recording)} of {recording.written_count} frames, the game can't be replayed from the start. Record with larger --record-size{Fore.RESET}")
+            sink.close()
+            sys.exit(1)
+        source = RecordingSource(recording)
+        read_input = ReplayedInput(recording, source)
+    elif args.video is not None:
+        source = VideoFileSource(args.video, args.video_step)
+    recorder = FrameRecorder(args.record, args.record_size * 2**20) if args.record is not None else None
+
+    try:
+        main(
+            elo=args.elo,
+            engine_path=args.engine,
+            movetime=args.movetime,
+            ponder=not args.no_ponder,
+            analysis_cache_path=args.analysis_cache,
+            analysis_cache_size=args.analysis_cache_size,
+            random_moves=args.random_moves,
+            book_path=args.book,
+            stream=args.stream,
+            stable_frames=args.stable_frames,
+            min_votes=args.min_votes,
+            motion_gate=args.motion_gate,
+            lock_board=args.board_lock,
+            detection_size=args.detection_size if args.detection_size > 0 else None,
+            refine_corners=args.refine_corners,
+            source=source,
+            read_input=read_input,
+            recorder=recorder,
+            use_camera_cache=not args.select_camera,
+            cell_model_path=args.cell_model
+        )
+    finally:
+        sink.close()
+        if recorder is not None:
+            recorder.close()
+        if metrics_stopped is not None:
+            metrics_stopped.set()
+            instrumentation.dump(args.metrics)
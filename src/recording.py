@@ -0,0 +1,155 @@
+import json
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable, Final
+
+import numpy as np
+from cv2.typing import MatLike
+
+if TYPE_CHECKING:
+    from src.camera import RecordingSource
+
+
+# bytes of the kept frames, about 340 full HD frames
+default_max_size: Final[int] = 2 * 1024**3
+
+frames_name: Final[str] = "frames.npy"
+timestamps_name: Final[str] = "timestamps.npy"
+sequence_name: Final[str] = "sequence.npy"
+# frames written in total, more than capacity when the ring has been overwritten
+count_name: Final[str] = "count.npy"
+inputs_name: Final[str] = "inputs.jsonl"
+
+
+# Ring buffer of the last frames in a directory, which take up to max_size bytes. Frames, their timestamps
+# and numbers are memory mapped .npy files, so a frame is copied once right into the page cache and the file
+# is readable after a crash. User inputs are JSON lines beside them
+class FrameRecorder:
+    directory: Path
+    max_size: int
+    # frames kept in the ring, it's known from the first frame's size
+    capacity: int | None
+
+    def __init__(self, directory: str | Path, max_size: int = default_max_size):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.capacity = None
+
+        # created by the first frame, all frames have its shape
+        self.__frames: np.memmap = None
+        self.__timestamps: np.memmap = None
+        self.__sequence: np.memmap = None
+        self.__written: np.memmap = None
+        self.__count = 0
+        self.__inputs = open(self.directory / inputs_name, 'w')
+
+    def write_frame(self, frame: MatLike, timestamp: float = None) -> None:
+        if self.__frames is None:
+            self.capacity = max(1, self.max_size // frame.nbytes)
+            self.__create(frame.shape)
+        if frame.shape != self.__frames.shape[1:]:
+            raise ValueError(f"Frame shape {frame.shape} differs from the recording one {self.__frames.shape[1:]}")
+
+        slot = self.__count % self.capacity
+        np.copyto(self.__frames[slot], frame)
+        self.__timestamps[slot] = timestamp if timestamp is not None else time.time()
+        self.__sequence[slot] = self.__count
+        self.__count += 1
+        self.__written[0] = self.__count
+
+    # the game reads a frame after the input, so the input belongs to the next frame
+    def write_input(self, value: str) -> None:
+        self.__inputs.write(json.dumps({"frame": self.__count, "timestamp": time.time(), "input": value}) + "\n")
+        self.__inputs.flush()
+
+    def close(self) -> None:
+        if self.__frames is not None:
+            for array in (self.__frames, self.__timestamps, self.__sequence, self.__written):
+                array.flush()
+        self.__inputs.close()
+
+    def __create(self, shape: tuple[int, ...]) -> None:
+        def create(name: str, dtype, item_shape=(), length=self.capacity) -> np.memmap:
+            return np.lib.format.open_memmap(self.directory / name, mode='w+', dtype=dtype, shape=(length, *item_shape))
+
+        self.__frames = create(frames_name, np.uint8, shape)
+        self.__timestamps = create(timestamps_name, np.float64)
+        self.__sequence = create(sequence_name, np.int64)
+        self.__sequence[:] = -1
+        self.__written = create(count_name, np.int64, length=1)
+
+
+class FrameRecording:
+    directory: Path
+    # {"frame", "timestamp", "input"} in the recorded order
+    inputs: list[dict]
+    # frames written while recording, only the last ones are kept when it's more than the ring capacity
+    written_count: int
+    # number of the oldest kept frame, it isn't 0 when the ring has been overwritten
+    first_frame: int
+
+    def __init__(self, directory: str | Path):
+        self.directory = Path(directory)
+        # copy on write, the pipeline gets the mapped pages and may draw on them
+        self.__frames = np.load(self.directory / frames_name, mmap_mode='c')
+        self.__timestamps = np.load(self.directory / timestamps_name, mmap_mode='r')
+        sequence = np.load(self.directory / sequence_name)
+
+        # slots from the oldest frame, the ring may have been overwritten many times
+        order = np.argsort(sequence, kind='stable')
+        self.__order = order[sequence[order] >= 0]
+        self.first_frame = int(sequence[self.__order[0]]) if len(self.__order) != 0 else 0
+        self.written_count = int(np.load(self.directory / count_name)[0])
+
+        with open(self.directory / inputs_name) as f:
+            self.inputs = [json.loads(line) for line in f if line.strip() != ""]
+
+    def __len__(self) -> int:
+        return len(self.__order)
+
+    # the first frames have been overwritten, so the recorded inputs don't match the kept frames
+    def is_wrapped(self) -> bool:
+        return self.first_frame > 0
+
+    # (timestamp, frame) of the i-th frame from the oldest one, the frame isn't copied
+    def get_frame(self, i: int) -> tuple[float, MatLike]:
+        slot = self.__order[i]
+        return float(self.__timestamps[slot]), self.__frames[slot]
+
+
+# input() replacement, which writes the answers to the recording
+class RecordedInput:
+    def __init__(self, recorder: FrameRecorder, input_function: Callable[[str], str] = input):
+        self.recorder = recorder
+        self.input_function = input_function
+
+    def __call__(self, prompt: str = "") -> str:
+        value = self.input_function(prompt)
+        self.recorder.write_input(value)
+        return value
+
+
+# input() replacement, which answers with the recorded inputs, EOFError is raised after the last one.
+# The frames source is moved to the frame the input has been given before, frames the game hasn't read
+# in the recording are skipped
+class ReplayedInput:
+    def __init__(self, recording: FrameRecording, source: 'RecordingSource' = None):
+        self.recording = recording
+        self.source = source
+        self.__position = 0
+
+    def __call__(self, prompt: str = "") -> str:
+        if self.__position >= len(self.recording.inputs):
+            raise EOFError("Recorded inputs have ended")
+        item = self.recording.inputs[self.__position]
+        self.__position += 1
+
+        if self.source is not None:
+            position = item["frame"] - self.recording.first_frame
+            if self.source.position < position:
+                self.source.seek(position)
+            elif self.source.position > position:
+                print(f"Exception: replay has read {self.source.position - position} frames more than the recording before the input {item['input']!r}")
+        print(f"{prompt}{item['input']}")
+        return item["input"]
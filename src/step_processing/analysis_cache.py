@@ -0,0 +1,77 @@
+import json
+import random
+import sqlite3
+import time
+from typing import Final
+
+from src import instrumentation
+from src.step_processing.uci_engine import SearchResult
+
+
+default_max_entries: Final[int] = 100000
+# MultiPV lines searched when the bot picks among candidates
+random_move_candidates: Final[int] = 4
+# candidates scored worse than the best one by more than this (centipawns) are never picked at random
+random_move_margin: Final[int] = 30
+
+
+# Engine results on disk, so the same positions aren't searched again in the next games.
+# The key is the FEN without the move counters, the same position is reached by different move orders.
+# Least recently used entries are removed above max_entries
+class AnalysisCache:
+    path: str
+    max_entries: int
+
+    def __init__(self, path: str, max_entries: int = default_max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self.__connection = sqlite3.connect(path)
+        with self.__connection:
+            self.__connection.execute(
+                "CREATE TABLE IF NOT EXISTS analysis ("
+                "key TEXT PRIMARY KEY, best_move TEXT NOT NULL, ponder_move TEXT, lines TEXT NOT NULL, used INTEGER NOT NULL)"
+            )
+            self.__connection.execute("CREATE INDEX IF NOT EXISTS analysis_used ON analysis (used)")
+
+    def get(self, fen: str, elo: int, movetime: int) -> SearchResult | None:
+        key = self.__key(fen, elo, movetime)
+        row = self.__connection.execute(
+            "SELECT best_move, ponder_move, lines FROM analysis WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            instrumentation.count("engine.cache_misses")
+            return None
+
+        instrumentation.count("engine.cache_hits")
+        with self.__connection:
+            self.__connection.execute("UPDATE analysis SET used = ? WHERE key = ?", (time.time_ns(), key))
+        best_move, ponder_move, lines = row
+        return SearchResult(best_move, ponder_move, [(move, score) for move, score in json.loads(lines)])
+
+    def put(self, fen: str, elo: int, movetime: int, result: SearchResult) -> None:
+        if result.best_move is None:
+            return
+        with self.__connection:
+            self.__connection.execute(
+                "INSERT OR REPLACE INTO analysis VALUES (?, ?, ?, ?, ?)",
+                (self.__key(fen, elo, movetime), result.best_move, result.ponder_move, json.dumps(result.lines), time.time_ns())
+            )
+            self.__connection.execute(
+                "DELETE FROM analysis WHERE key IN (SELECT key FROM analysis ORDER BY used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+
+    def close(self) -> None:
+        self.__connection.close()
+
+    def __key(self, fen: str, elo: int, movetime: int) -> str:
+        position = " ".join(fen.split()[:4])
+        return f"{position}|{elo}|{movetime}"
+
+
+# one of the candidate lines close to the best one, the best move when there are no lines
+def choose_random_move(result: SearchResult, margin: int = random_move_margin) -> str:
+    if len(result.lines) == 0:
+        return result.best_move
+    best_score = max(score for _, score in result.lines)
+    return random.choice([move for move, score in result.lines if score >= best_score - margin])
@@ -1,16 +1,46 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
 from typing import Final
 
+import numpy as np
 from colorama import Fore
 
+from src.cv.chessboard.chessboard import Position
 from src.step_processing.chess_piece import Piece, PieceType
 
 
 start_fen: Final[str] = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1'
 
+cols_names: Final[str] = "abcdefgh"
+# board array codes, black pieces are negative
+piece_codes: Final[dict[PieceType, int]] = {
+    PieceType.EMPTY: 0,
+    PieceType.PAN: 1,
+    PieceType.KNIGHT: 2,
+    PieceType.BISHOP: 3,
+    PieceType.ROOK: 4,
+    PieceType.QUEEN: 5,
+    PieceType.KING: 6,
+}
+piece_types: Final[tuple[PieceType, ...]] = tuple(piece_codes)
+# Position value of the board code + 6
+occupancy_table: Final[np.ndarray] = np.int8([Position.BLACK.value] * 6 + [Position.EMPTY.value] + [Position.WHITE.value] * 6)
+# castling rights lost when a piece leaves or is taken on the square
+castling_squares: Final[dict[tuple[int, int], str]] = {
+    (0, 4): "KQ", (0, 7): "K", (0, 0): "Q",
+    (7, 4): "kq", (7, 7): "k", (7, 0): "q",
+}
+# (row, col) steps of the pieces
+knight_steps: Final[tuple[tuple[int, int], ...]] = ((1, 2), (2, 1), (2, -1), (1, -2), (-1, -2), (-2, -1), (-2, 1), (-1, 2))
+king_steps: Final[tuple[tuple[int, int], ...]] = ((1, 0), (1, 1), (0, 1), (-1, 1), (-1, 0), (-1, -1), (0, -1), (1, -1))
+rook_steps: Final[tuple[tuple[int, int], ...]] = ((1, 0), (0, 1), (-1, 0), (0, -1))
+bishop_steps: Final[tuple[tuple[int, int], ...]] = ((1, 1), (-1, 1), (-1, -1), (1, -1))
+promotion_names: Final[str] = "qrbn"
+
+
 @dataclass
 class ChessboardState:
-    grid: tuple[tuple[Piece]]
+    # (8, 8) int8 piece codes, row 0 is the first rank
+    board: np.ndarray
 
     castling: str
 
@@ -22,8 +52,17 @@ class ChessboardState:
 
     step_num: int
 
+    def get_piece(self, i: int, j: int) -> Piece:
+        code = int(self.board[i, j])
+        return Piece(piece_types[abs(code)], code > 0)
+
+    # Position values of the cells, compared with Chessboard.cells as is
+    def get_occupancy(self) -> np.ndarray:
+        return occupancy_table[self.board + 6]
+
     def print(self):
-        for row in self.grid:
+        for i in range(8):
+            row = [self.get_piece(i, j) for j in range(8)]
             print(*[f"{Fore.BLUE if not p.white else ''}{p.type.name}{Fore.RESET}" for p in row])
 
     def can_castle(self, white: bool, short_side: bool) -> bool:
@@ -38,45 +77,218 @@ class ChessboardState:
             else:
                 return 'k' in self.castling
 
+    # uci move, the move is expected to be legal
+    def apply_move(self, move_name: str) -> None:
+        j1, i1 = cols_names.index(move_name[0]), int(move_name[1]) - 1
+        j2, i2 = cols_names.index(move_name[2]), int(move_name[3]) - 1
+        code = int(self.board[i1, j1])
+        is_capture = self.board[i2, j2] != 0
+        is_pan = abs(code) == piece_codes[PieceType.PAN]
+
+        if is_pan and j1 != j2 and not is_capture:
+            # en passant, the taken pan stays on the start row
+            self.board[i1, j2] = 0
+            is_capture = True
+        if abs(code) == piece_codes[PieceType.KING] and abs(j2 - j1) == 2:
+            rook_from, rook_to = (7, 5) if j2 > j1 else (0, 3)
+            self.board[i1, rook_to], self.board[i1, rook_from] = self.board[i1, rook_from], 0
+        if len(move_name) == 5:
+            code = piece_codes[PieceType(move_name[4].upper())] * (1 if code > 0 else -1)
+
+        self.board[i2, j2], self.board[i1, j1] = code, 0
+
+        lost_rights = castling_squares.get((i1, j1), "") + castling_squares.get((i2, j2), "")
+        self.castling = "".join(c for c in self.castling if c not in lost_rights)
+        self.coords_pan_did_long_step = f"{cols_names[j1]}{(i1 + i2) // 2 + 1}" if is_pan and abs(i2 - i1) == 2 else "-"
+        self.draw_counter = 0 if is_pan or is_capture else self.draw_counter + 1
+        if not self.is_white_step_side:
+            self.step_num += 1
+        self.is_white_step_side = not self.is_white_step_side
+
+    # uci moves of the side to move, a promotion is given for each piece
+    def get_legal_moves(self) -> list[str]:
+        sign = 1 if self.is_white_step_side else -1
+        legal_moves = []
+        for move in self.__get_pseudo_legal_moves(sign):
+            state = replace(self, board=self.board.copy())
+            state.apply_move(move)
+            if not state.__is_king_attacked(sign):
+                legal_moves.append(move)
+        return legal_moves
+
+    # the side to move is in check
+    def is_check(self) -> bool:
+        return self.__is_king_attacked(1 if self.is_white_step_side else -1)
+
+    # sign is 1 for the white pieces, -1 for the black ones
+    def __get_pseudo_legal_moves(self, sign: int) -> list[str]:
+        board = self.board.tolist()
+        moves = []
+        for i in range(8):
+            for j in range(8):
+                code = board[i][j] * sign
+                if code <= 0:
+                    continue
+                if code == piece_codes[PieceType.PAN]:
+                    moves.extend(self.__get_pan_moves(board, i, j, sign))
+                    continue
+
+                if code == piece_codes[PieceType.KNIGHT] or code == piece_codes[PieceType.KING]:
+                    steps, is_sliding = knight_steps if code == piece_codes[PieceType.KNIGHT] else king_steps, False
+                else:
+                    steps, is_sliding = {
+                        piece_codes[PieceType.BISHOP]: bishop_steps,
+                        piece_codes[PieceType.ROOK]: rook_steps,
+                        piece_codes[PieceType.QUEEN]: rook_steps + bishop_steps,
+                    }[code], True
+                for di, dj in steps:
+                    i2, j2 = i + di, j + dj
+                    while 0 <= i2 < 8 and 0 <= j2 < 8 and board[i2][j2] * sign <= 0:
+                        moves.append(get_move_name(i, j, i2, j2))
+                        if not is_sliding or board[i2][j2] != 0:
+                            break
+                        i2, j2 = i2 + di, j2 + dj
+
+        moves.extend(self.__get_castling_moves(board, sign))
+        return moves
+
+    def __get_pan_moves(self, board: list[list[int]], i: int, j: int, sign: int) -> list[str]:
+        i2 = i + sign
+        targets = []
+        if board[i2][j] == 0:
+            targets.append((i2, j))
+            start_row = 1 if sign > 0 else 6
+            if i == start_row and board[i2 + sign][j] == 0:
+                targets.append((i2 + sign, j))
+
+        en_passant = None
+        if self.coords_pan_did_long_step != "-":
+            en_passant = (int(self.coords_pan_did_long_step[1]) - 1, cols_names.index(self.coords_pan_did_long_step[0]))
+        for j2 in (j - 1, j + 1):
+            if 0 <= j2 < 8 and (board[i2][j2] * sign < 0 or (i2, j2) == en_passant):
+                targets.append((i2, j2))
+
+        moves = []
+        for i3, j3 in targets:
+            name = get_move_name(i, j, i3, j3)
+            if i3 == 0 or i3 == 7:
+                moves.extend(name + promotion for promotion in promotion_names)
+            else:
+                moves.append(name)
+        return moves
+
+    # the king doesn't leave, cross or come to an attacked square
+    def __get_castling_moves(self, board: list[list[int]], sign: int) -> list[str]:
+        row = 0 if sign > 0 else 7
+        short_right, long_right = ("K", "Q") if sign > 0 else ("k", "q")
+        king, rook = sign * piece_codes[PieceType.KING], sign * piece_codes[PieceType.ROOK]
+        if board[row][4] != king:
+            return []
+
+        moves = []
+        if short_right in self.castling and board[row][7] == rook and board[row][5] == board[row][6] == 0:
+            if not any(self.__is_attacked(board, row, j, -sign) for j in (4, 5, 6)):
+                moves.append(get_move_name(row, 4, row, 6))
+        if long_right in self.castling and board[row][0] == rook and board[row][1] == board[row][2] == board[row][3] == 0:
+            if not any(self.__is_attacked(board, row, j, -sign) for j in (4, 3, 2)):
+                moves.append(get_move_name(row, 4, row, 2))
+        return moves
+
+    def __is_king_attacked(self, sign: int) -> bool:
+        board = self.board.tolist()
+        king = sign * piece_codes[PieceType.KING]
+        i, j = next((i, j) for i in range(8) for j in range(8) if board[i][j] == king)
+        return self.__is_attacked(board, i, j, -sign)
+
+    # the square is attacked by the pieces of the sign
+    def __is_attacked(self, board: list[list[int]], i: int, j: int, sign: int) -> bool:
+        # pans attack forward, so they stand a row behind the square
+        pan_row = i - sign
+        if 0 <= pan_row < 8:
+            for pan_col in (j - 1, j + 1):
+                if 0 <= pan_col < 8 and board[pan_row][pan_col] == sign * piece_codes[PieceType.PAN]:
+                    return True
+
+        for steps, piece in ((knight_steps, PieceType.KNIGHT), (king_steps, PieceType.KING)):
+            for di, dj in steps:
+                i2, j2 = i + di, j + dj
+                if 0 <= i2 < 8 and 0 <= j2 < 8 and board[i2][j2] == sign * piece_codes[piece]:
+                    return True
+
+        for steps, piece in ((rook_steps, PieceType.ROOK), (bishop_steps, PieceType.BISHOP)):
+            attackers = (sign * piece_codes[piece], sign * piece_codes[PieceType.QUEEN])
+            for di, dj in steps:
+                i2, j2 = i + di, j + dj
+                while 0 <= i2 < 8 and 0 <= j2 < 8:
+                    if board[i2][j2] != 0:
+                        if board[i2][j2] in attackers:
+                            return True
+                        break
+                    i2, j2 = i2 + di, j2 + dj
+        return False
+
+    def to_fen(self) -> str:
+        rows = []
+        for i in range(7, -1, -1):
+            row, empty = "", 0
+            for j in range(8):
+                code = int(self.board[i, j])
+                if code == 0:
+                    empty += 1
+                    continue
+                if empty != 0:
+                    row += str(empty)
+                    empty = 0
+                name = piece_types[abs(code)].value
+                row += name if code > 0 else name.lower()
+            rows.append(row + (str(empty) if empty != 0 else ""))
+
+        return " ".join([
+            "/".join(rows),
+            "w" if self.is_white_step_side else "b",
+            self.castling if self.castling != "" else "-",
+            self.coords_pan_did_long_step,
+            str(self.draw_counter),
+            str(self.step_num),
+        ])
+
+
+def get_move_name(i1: int, j1: int, i2: int, j2: int) -> str:
+    return f"{cols_names[j1]}{i1 + 1}{cols_names[j2]}{i2 + 1}"
+
 
 def create_from_fen(fen: str) -> ChessboardState:
-    grid = [[Piece(PieceType.EMPTY, False) for i in range(8)] for j in range(8)]
+    board = np.zeros((8, 8), dtype=np.int8)
 
     array = fen.split(' ')
 
     positions = array[0]
-    pos = 0
     row = 7
     col = 0
-    for i in range(len(positions)):
-        char = positions[i]
-
+    for char in positions:
         if char.isdigit():
-            n = int(char)
-            pos += n
-            col += n
+            col += int(char)
         elif char == '/':
             row -= 1
             col = 0
-            continue
         else:
-            piece = PieceType(char.upper())
-            grid[row][col] = Piece(piece, char.isupper())
+            code = piece_codes[PieceType(char.upper())]
+            board[row, col] = code if char.isupper() else -code
             col += 1
 
     # step side
     white = array[1] == 'w'
-    
+
     castling = array[2] if array[2] != "-" else ''
 
     coords_pan_did_long_step = array[3]
 
     draw_counter = int(array[4])
 
-    step = int(array[-1])        
+    step = int(array[-1])
 
     return ChessboardState(
-        grid=tuple(tuple(p for p in row) for row in grid),
+        board=board,
         castling=castling,
         is_white_step_side=white,
         coords_pan_did_long_step=coords_pan_did_long_step,
@@ -0,0 +1,51 @@
+from dataclasses import replace
+from typing import Final
+
+import numpy as np
+
+from src import instrumentation
+from src.step_processing.chessboard_state import ChessboardState
+
+
+# cells of the observed board which may be misclassified
+max_signature_distance: Final[int] = 1
+
+
+# Occupancy of the board after every legal move, so the move on the camera board is found by the lookup
+# of its cells. Promotions to other pieces look the same as the queen one and aren't indexed
+class MoveIndex:
+    moves: list[str]
+
+    def __init__(self, state: ChessboardState, legal_moves: list[str]):
+        self.moves = []
+        self.__occupancy = state.get_occupancy()
+        self.__index: dict[bytes, int] = {}
+
+        signatures = []
+        for name in legal_moves:
+            if len(name) == 5 and name[4] != 'q':
+                continue
+            next_state = replace(state, board=state.board.copy())
+            next_state.apply_move(name)
+            signature = next_state.get_occupancy()
+            self.__index[signature.tobytes()] = len(self.moves)
+            self.moves.append(name)
+            signatures.append(signature)
+        self.__signatures = np.stack(signatures) if len(signatures) != 0 else np.empty((0, 8, 8), dtype=np.int8)
+
+    # cells are Position values of the camera board
+    def find_move(self, cells: np.ndarray) -> str | None:
+        cells = np.ascontiguousarray(cells, dtype=np.int8)
+        i = self.__index.get(cells.tobytes())
+        if i is not None:
+            return self.moves[i]
+
+        # a board close to the current one is a misclassified cell or a move in progress, not a move
+        if (cells != self.__occupancy).sum() <= max_signature_distance:
+            return None
+        distances = (self.__signatures != cells).sum(axis=(1, 2))
+        close = np.flatnonzero(distances <= max_signature_distance)
+        if len(close) != 1:
+            return None
+        instrumentation.count("step.moves_found_by_distance")
+        return self.moves[int(close[0])]
@@ -0,0 +1,86 @@
+import random
+from typing import Final
+
+import numpy as np
+
+from src.step_processing.chessboard_state import ChessboardState, cols_names, piece_codes
+from src.step_processing.chess_piece import PieceType
+from src.step_processing.polyglot_random import random64
+
+
+# book entries are sorted by key, all fields are big endian
+entry_dtype: Final[np.dtype] = np.dtype([('key', '>u8'), ('move', '>u2'), ('weight', '>u2'), ('learn', '>u4')])
+
+promotion_names: Final[str] = " nbrq"
+castling_offset: Final[int] = 768
+en_passant_offset: Final[int] = 772
+turn_offset: Final[int] = 780
+# castling is written as the king takes its rook
+castling_moves: Final[dict[str, str]] = {"e1h1": "e1g1", "e1a1": "e1c1", "e8h8": "e8g8", "e8a8": "e8c8"}
+
+
+# Polyglot .bin book, the file is memory mapped and positions are found by binary search over the keys,
+# so only the touched pages are read
+class OpeningBook:
+    path: str
+
+    def __init__(self, path: str):
+        self.path = path
+        self.__entries = np.memmap(path, dtype=entry_dtype, mode='r')
+
+    # (uci move, weight) of the position, empty when the position isn't in the book
+    def find_moves(self, state: ChessboardState) -> list[tuple[str, int]]:
+        key = np.uint64(polyglot_hash(state))
+        keys = self.__entries['key']
+        start = int(np.searchsorted(keys, key, side='left'))
+        end = int(np.searchsorted(keys, key, side='right'))
+        return [
+            (self.__decode_move(state, int(entry['move'])), int(entry['weight']))
+            for entry in self.__entries[start:end]
+        ]
+
+    # random move in proportion to the weights
+    def choose_move(self, state: ChessboardState) -> str | None:
+        moves = [(move, weight) for move, weight in self.find_moves(state) if weight > 0]
+        if len(moves) == 0:
+            return None
+        return random.choices([move for move, _ in moves], weights=[weight for _, weight in moves])[0]
+
+    def __decode_move(self, state: ChessboardState, move: int) -> str:
+        to_col, to_row = move & 7, (move >> 3) & 7
+        from_col, from_row = (move >> 6) & 7, (move >> 9) & 7
+        promotion = (move >> 12) & 7
+
+        name = f"{cols_names[from_col]}{from_row + 1}{cols_names[to_col]}{to_row + 1}"
+        if promotion != 0:
+            name += promotion_names[promotion]
+        if abs(state.board[from_row, from_col]) == piece_codes[PieceType.KING] and name in castling_moves:
+            name = castling_moves[name]
+        return name
+
+
+def polyglot_hash(state: ChessboardState) -> int:
+    key = 0
+    # board codes go in the polyglot kinds order, black piece of the kind goes first
+    squares = np.flatnonzero(state.board)
+    codes = state.board.ravel()[squares].astype(np.int64)
+    for i in (64 * (2 * (np.abs(codes) - 1) + (codes > 0)) + squares).tolist():
+        key ^= random64[i]
+
+    for i, right in enumerate("KQkq"):
+        if right in state.castling:
+            key ^= random64[castling_offset + i]
+
+    # en passant file counts only when a pawn of the side to move stands next to the pawn which has moved
+    if state.coords_pan_did_long_step != '-':
+        col = cols_names.index(state.coords_pan_did_long_step[0])
+        row = 4 if state.is_white_step_side else 3
+        for c in (col - 1, col + 1):
+            if 0 <= c < 8:
+                if state.board[row, c] == piece_codes[PieceType.PAN] * (1 if state.is_white_step_side else -1):
+                    key ^= random64[en_passant_offset + col]
+                    break
+
+    if state.is_white_step_side:
+        key ^= random64[turn_offset]
+    return key
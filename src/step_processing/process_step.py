@@ -1,15 +1,20 @@
 from enum import Enum
-from typing import Final
+from typing import Callable, Final
 
+import numpy as np
 from colorama import Fore
 
-from src.cv.chessboard.chessboard import Chessboard, Position
-from src.step_processing.chessboard_state import ChessboardState, create_from_fen, start_fen
-from src.step_processing.chess_piece import Piece, PieceType
-from stockfish import Stockfish
+from src import instrumentation
+from src.cv.chessboard.chessboard import Chessboard
+from src.step_processing.chessboard_state import ChessboardState, cols_names, create_from_fen, start_fen
+from src.step_processing.move_index import MoveIndex
+from src.step_processing.opening_book import OpeningBook
+from src.step_processing.analysis_cache import AnalysisCache, choose_random_move
+from src.step_processing.uci_engine import SearchResult, UciEngine
 
 
-cols_names: Final[str] = "abcdefgh"
+# bot's search time in milliseconds
+default_movetime: Final[int] = 500
 
 
 class Move:
@@ -26,7 +31,14 @@ class Move:
             self.name = name
     
     def __get_step_name(self, i1, j1, i2, j2) -> str:
-        return f"{cols_names[j1]}{i1}{cols_names[j2]}{i2}"
+        return f"{cols_names[j1]}{i1 + 1}{cols_names[j2]}{i2 + 1}"
+
+
+def create_move_from_name(name: str) -> Move:
+    start = (int(name[1]) - 1, cols_names.index(name[0]))
+    end = (int(name[3]) - 1, cols_names.index(name[2]))
+    return Move(start, end, name)
+
 
 class PlayingSide(Enum):
     WHITE = 0
@@ -35,154 +47,172 @@ class PlayingSide(Enum):
 
 class StepProcessor:
     bot_playing_side: PlayingSide
-    stockfish_board: Stockfish
+    engine: UciEngine
+    movetime: int
+    is_pondering_enabled: bool
+    analysis_cache: AnalysisCache | None
+    # pick among the candidate moves close to the best one instead of the best one
+    is_random_moves: bool
+    opening_book: OpeningBook | None
+    # the book isn't looked up anymore after the first position which isn't in it,
+    # the engine isn't needed before and is started then
+    is_in_book: bool
+    # input() or its replacement for the recorded games
+    input_function: Callable[[str], str]
+    # uci moves from the start position
+    moves: list[str]
     
-    current_fen: ChessboardState = create_from_fen(start_fen)
-
-    def __init__(self, playing_side: PlayingSide, stockfish_board: Stockfish):
+    current_fen: ChessboardState
+
+    def __init__(
+        self,
+        playing_side: PlayingSide,
+        engine: UciEngine,
+        movetime: int = default_movetime,
+        ponder: bool = True,
+        analysis_cache: AnalysisCache = None,
+        random_moves: bool = False,
+        opening_book: OpeningBook = None,
+        input_function: Callable[[str], str] = input
+    ):
         self.bot_playing_side = playing_side
-        self.stockfish_board = stockfish_board
-
-    def process_enemy_step(self, new_chessboard: Chessboard) -> bool:
+        self.engine = engine
+        self.movetime = movetime
+        self.is_pondering_enabled = ponder
+        self.analysis_cache = analysis_cache
+        self.is_random_moves = random_moves
+        self.opening_book = opening_book
+        self.is_in_book = opening_book is not None
+        self.input_function = input_function
+        self.moves = []
+        self.current_fen = create_from_fen(start_fen)
+        self.__legal_moves = None
+        self.__move_index = None
+        if not self.is_in_book:
+            self.engine.new_game()
+
+    def process_enemy_step(self, new_chessboard: Chessboard, interactive: bool = True) -> bool:
         changed_positions = self.__find_changed_positions(new_chessboard)
-        move = self.__find_move(changed_positions, new_chessboard)
+        with instrumentation.span("step.find_move"):
+            move = self.__find_move(new_chessboard)
 
         if move is None:
-            print(f"{Fore.RED}Exception: Couldn't find move!{Fore.RESET}")
-            new_chessboard.show_highlighted_squares(changed_positions)
+            instrumentation.count("step.moves_not_found")
+            print(f"{Fore.RED}Exception: Couldn't find legal move! Come back to previous position:{Fore.RESET}")
+            self.current_fen.print()
+            if interactive:
+                new_chessboard.show_highlighted_squares(changed_positions)
             return False
         
-        new_chessboard.show_highlighted_squares([move.start, move.end])
-        print(f"{Fore.CYAN}Were move {move.name}? (y/n){Fore.RESET}")
-        while True:
-            s = input("-> ")
-            if s == 'y':
-                break
-            elif s == 'n':
-                return False
-        
-        if not self.stockfish_board.is_move_correct(move.name):
-            print(f"{Fore.RED}Exception: Incorrect move ({move.name})! Come back to previous position:{Fore.RESET}")
-            self.stockfish_board.get_board_visual()
-            return False
+        if interactive:
+            new_chessboard.show_highlighted_squares([move.start, move.end])
+            print(f"{Fore.CYAN}Were move {move.name}? (y/n){Fore.RESET}")
+            while True:
+                s = self.input_function("-> ")
+                if s == 'y':
+                    break
+                elif s == 'n':
+                    return False
         
         # Record player's move
+        instrumentation.count("step.moves_found")
         print(f"{Fore.CYAN}Nice! You've done move {move.name}{Fore.RESET}")
-        self.stockfish_board.make_moves_from_current_position([move.name])
-        self.current_fen = create_from_fen(self.stockfish_board.get_fen_position())
-        self.stockfish_board.get_board_visual()
+        with instrumentation.span("step.engine_update"):
+            self.__push_move(move.name)
 
         return True
     
+    def is_board_changed(self, new_chessboard: Chessboard) -> bool:
+        return len(self.__find_changed_positions(new_chessboard)) != 0
+
     def make_bots_move(self) -> bool:
-        bot_move = self.stockfish_board.get_best_move_time(time=500)
+        with instrumentation.span("step.engine_best_move"):
+            result = self.__search()
+        if result.best_move is None:
+            print(f"{Fore.RED}Exception: Engine has no move{Fore.RESET}")
+            return False
+        bot_move = choose_random_move(result) if self.is_random_moves else result.best_move
         print(f"{Fore.BLUE}Bot's done move {bot_move}{Fore.RESET}")
-        self.stockfish_board.make_moves_from_current_position([bot_move])
-        self.current_fen = create_from_fen(self.stockfish_board.get_fen_position())
-        self.stockfish_board.get_board_visual()
-
+        with instrumentation.span("step.engine_update"):
+            self.__push_move(bot_move)
+        self.__get_move_index()
+
+        # the engine thinks on the expected reply while the player does,
+        # the expected reply is known for the best move only
+        if self.is_pondering_enabled and bot_move == result.best_move and result.ponder_move is not None:
+            expected_moves = [*self.moves, result.ponder_move]
+            # the analysis cache looks the position up by the engine's fen, which would stop the search
+            if self.analysis_cache is not None:
+                self.engine.get_position_info(expected_moves)
+            self.engine.ponder(expected_moves, self.movetime)
         return True
-    
-    def __find_move(self, changed_positions: list[tuple[int, int]], new_chessboard: Chessboard) -> Move:
-        from_positions: list[tuple[int, int]] = []
-        to_positions: list[tuple[int, int]] = []
-
-        for i, j in changed_positions:
-            old_piece: Piece = self.current_fen.grid[i][j]
-            new_data: Position = new_chessboard.positions[i][j]
-
-            if self.__is_enemy(new_data):
-                to_positions.append((i, j))
-            elif self.__was_enemy(old_piece):
-                from_positions.append((i, j))
-
-        ## In case simple move (1 figure moved)
-        if len(from_positions) == 1 and len(to_positions) == 1:
-            f = from_positions[0]
-            to = to_positions[0]
-            return Move(f, to)
-        
-        castling_move = self.__get_castling_move(from_positions, to_positions)
-        if castling_move is not None:
-            return castling_move
-        
-    def __find_changed_positions(self, new_chessboard: Chessboard) -> list[tuple[int, int]]:
-        changed = []
-        for i in range(8):
-            for j in range(8):
-                old_piece: Piece = self.current_fen.grid[i][j]
-                new_data: Position = new_chessboard.positions[i][j]
-
-                if not self.__is_changed(old_piece, new_data):
-                    continue
-                changed.append((i, j))
-        return changed
 
-
-    def __is_enemy(self, position: Position) -> bool:
-        if self.bot_playing_side == PlayingSide.WHITE:
-            return position == Position.BLACK
-        else:
-            return position == Position.WHITE
-        
-    def __was_enemy(self, piece: Piece) -> bool:
-        if self.bot_playing_side == PlayingSide.WHITE:
-            return not piece.white and piece.type != PieceType.EMPTY
-        else:
-            return piece.white and piece.type != PieceType.EMPTY
-
-
-    def __is_changed(self, old_piece: Piece, new_position: Position) -> bool:
-        match new_position:
-            case Position.WHITE:
-                return (not old_piece.white and old_piece.type != PieceType.EMPTY) or old_piece.type == PieceType.EMPTY
-            case Position.BLACK:
-                return (old_piece.white and old_piece.type != PieceType.EMPTY) or old_piece.type == PieceType.EMPTY
-            case Position.EMPTY:
-                return old_piece.type != PieceType.EMPTY
-
-    def __get_castling_move(self, from_pos: list[tuple[int, int]], to_pos: list[tuple[int, int]]) -> Move | None:
-        if (len(from_pos) != 2) or (len(to_pos) != 2):
+    def __search(self) -> SearchResult:
+        if self.is_in_book:
+            book_move = self.__find_book_move()
+            if book_move is not None:
+                return SearchResult(book_move)
+
+        if self.analysis_cache is None:
+            return self.engine.best_move(self.moves, self.movetime)
+
+        fen = self.engine.get_position_info(self.moves).fen
+        elo = int(self.engine.options.get("UCI_Elo", "0"))
+        result = self.analysis_cache.get(fen, elo, self.movetime)
+        if result is not None:
+            self.engine.stop_pondering()
+            return result
+        result = self.engine.best_move(self.moves, self.movetime)
+        self.analysis_cache.put(fen, elo, self.movetime, result)
+        return result
+
+    def __find_book_move(self) -> str | None:
+        with instrumentation.span("step.book_lookup"):
+            move = self.opening_book.choose_move(self.current_fen)
+        # hash collisions give moves of other positions
+        if move is None or move not in self.__get_legal_moves():
+            print(f"{Fore.BLUE}Bot has left the opening book{Fore.RESET}")
+            self.is_in_book = False
+            self.engine.new_game()
             return None
-        for _, col in [*from_pos, *to_pos]:
-            if self.bot_playing_side == PlayingSide.WHITE:
-                if col != 7:
-                    return None
-            else:
-                if col != 0:
-                    return None
-        
-        left_from = from_pos[0]
-        right_from = from_pos[1]
-        
-        left_to = to_pos[0]
-        right_to = to_pos[1]
-
-        if (
-            (left_from[1] == 0 and right_from[1] == 4) and
-            (left_to[1] == 2 and right_to[1] == 3)
-        ): # long castling
-            return Move(right_from, left_to, "O-O-O")
-        elif (
-            (left_from[1] == 4 and right_from[1] == 7) and
-            (left_to[1] == 5 and right_to[1] == 6)
-        ): # short castling
-            return Move(left_from, right_to, "O-O")
-        return None
+        instrumentation.count("step.book_moves")
+        return move
+
+    def __push_move(self, move_name: str) -> None:
+        self.moves.append(move_name)
+        self.current_fen.apply_move(move_name)
+        self.__legal_moves = None
+        self.__move_index = None
+
+    def __get_legal_moves(self) -> list[str]:
+        if self.__legal_moves is None:
+            with instrumentation.span("step.legal_moves"):
+                self.__legal_moves = self.current_fen.get_legal_moves()
+        return self.__legal_moves
+
+    # built while the player thinks
+    def __get_move_index(self) -> MoveIndex:
+        if self.__move_index is None:
+            self.__move_index = MoveIndex(self.current_fen, self.__get_legal_moves())
+        return self.__move_index
     
+    def __find_move(self, new_chessboard: Chessboard) -> Move | None:
+        name = self.__get_move_index().find_move(new_chessboard.cells)
+        return create_move_from_name(name) if name is not None else None
+
+    def __find_changed_positions(self, new_chessboard: Chessboard) -> list[tuple[int, int]]:
+        changed = np.argwhere(self.current_fen.get_occupancy() != new_chessboard.cells)
+        return [(i, j) for i, j in changed.tolist()]
+
     def is_game_ended(self, is_bot) -> bool:
         game_result = self.__get_game_over_status()
         if game_result is None:
             return False
         print(f"{Fore.MAGENTA}{'Bot' if is_bot else 'You'} has ended game! {game_result.upper()}!{Fore.RESET}")
+        return True
     
     def __get_game_over_status(self):
-        evaluation = self.stockfish_board.get_evaluation()
-        
-        if evaluation["type"] == "mate" and evaluation["value"] == 0:
-            return "checkmate"
-        elif evaluation["type"] == "mate" and abs(evaluation["value"]) > 0:
-            return "stalemate"
-        else:
+        if len(self.__get_legal_moves()) != 0:
             return None
+        return "checkmate" if self.current_fen.is_check() else "stalemate"
 
@@ -0,0 +1,264 @@
+import asyncio
+import threading
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Final
+
+from src import instrumentation
+
+
+# seconds to wait for the replies of the commands which don't search
+command_timeout: Final[float] = 10.0
+# positions info is kept for this many last positions
+max_cached_positions: Final[int] = 16
+# mate scores are converted to centipawns as mate_score - moves to the mate
+mate_score: Final[int] = 100000
+
+
+@dataclass
+class SearchResult:
+    best_move: str | None
+    ponder_move: str | None = None
+    # (first move, centipawns score for the side to move) of every MultiPV line, the best one first
+    lines: list[tuple[str, int]] = field(default_factory=list)
+
+
+@dataclass
+class PositionInfo:
+    fen: str
+    legal_moves: list[str]
+    checkers: list[str]
+
+
+class PendingSearch:
+    def __init__(self, future: asyncio.Future):
+        self.future = future
+        self.lines: dict[int, tuple[str, int]] = {}
+
+
+class PendingReply:
+    def __init__(self, future: asyncio.Future, terminator: str):
+        self.future = future
+        self.terminator = terminator
+        self.lines: list[str] = []
+
+
+# Stockfish driver: the process is started on the first call and kept running between moves,
+# commands are written at once and replies are matched to the waiting calls by the stdout reader.
+# Positions are move lists from the start position.
+class UciEngine:
+    path: str
+    options: dict[str, str]
+
+    def __init__(self, path: str, options: dict[str, str | int] = None):
+        self.path = path
+        self.options = {name: str(value) for name, value in (options or {}).items()}
+
+        self.__process: asyncio.subprocess.Process = None
+        self.__reader: asyncio.Task = None
+        self.__searches: deque[PendingSearch] = deque()
+        self.__replies: deque[PendingReply] = deque()
+        self.__ponder: tuple[tuple[str], asyncio.Future] = None
+        self.__positions: dict[tuple[str], PositionInfo] = {}
+
+        self.__loop = asyncio.new_event_loop()
+        self.__thread = threading.Thread(target=self.__loop.run_forever, name="uci-engine", daemon=True)
+        self.__thread.start()
+
+    def start(self) -> 'UciEngine':
+        self.__call(self.__start(), command_timeout)
+        return self
+
+    def close(self) -> None:
+        if self.__loop.is_closed():
+            return
+        self.__call(self.__close(), command_timeout)
+        self.__loop.call_soon_threadsafe(self.__loop.stop)
+        self.__thread.join()
+        self.__loop.close()
+
+    def set_option(self, name: str, value: str | int) -> None:
+        self.options[name] = str(value)
+        if self.__process is not None:
+            self.__call(self.__set_options({name: str(value)}), command_timeout)
+
+    def new_game(self) -> None:
+        self.__call(self.__new_game(), command_timeout)
+
+    def get_position_info(self, moves: list[str]) -> PositionInfo:
+        return self.__call(self.__get_position_info(tuple(moves)), command_timeout)
+
+    # ponderhit answers at once when the engine has been pondering on these moves for movetime already
+    def best_move(self, moves: list[str], movetime: int) -> SearchResult:
+        return self.__call(self.__best_move(tuple(moves), movetime), movetime / 1000 + command_timeout)
+
+    # moves end with the expected reply, the search goes on until the next best_move call
+    def ponder(self, moves: list[str], movetime: int) -> None:
+        self.__call(self.__start_pondering(tuple(moves), movetime), command_timeout)
+
+    # the result is known without the engine, the pondering search isn't needed anymore
+    def stop_pondering(self) -> None:
+        self.__call(self.__stop_pondering(), command_timeout)
+
+    def __call(self, coroutine, timeout: float):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.__loop).result(timeout)
+
+    async def __start(self) -> None:
+        if self.__process is not None:
+            return
+        self.__process = await asyncio.create_subprocess_exec(
+            self.path, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE
+        )
+        self.__reader = asyncio.create_task(self.__read())
+        await self.__request(["uci"], "uciok")
+        await self.__set_options(self.options)
+
+    async def __close(self) -> None:
+        if self.__process is None:
+            return
+        await self.__stop_pondering()
+        self.__send("quit")
+        try:
+            await asyncio.wait_for(self.__process.wait(), command_timeout)
+        except asyncio.TimeoutError:
+            self.__process.kill()
+        await self.__reader
+        self.__process = None
+
+    async def __set_options(self, options: dict[str, str]) -> None:
+        await self.__start()
+        for name, value in options.items():
+            self.__send(f"setoption name {name} value {value}")
+        await self.__request(["isready"], "readyok")
+
+    async def __new_game(self) -> None:
+        await self.__start()
+        await self.__stop_pondering()
+        self.__positions.clear()
+        await self.__request(["ucinewgame", "isready"], "readyok")
+
+    async def __get_position_info(self, moves: tuple[str]) -> PositionInfo:
+        info = self.__positions.get(moves)
+        if info is not None:
+            return info
+
+        await self.__start()
+        # perft waits for the running search, pondering would never end
+        await self.__stop_pondering(moves)
+        position = self.__position(moves)
+        perft, board = await asyncio.gather(
+            self.__request([position, "go perft 1"], "Nodes searched"),
+            self.__request([position, "d"], "Checkers:"),
+        )
+
+        legal_moves = [line.split(":")[0] for line in perft if ":" in line and not line.startswith("Nodes")]
+        fen = next(line[len("Fen: "):] for line in board if line.startswith("Fen: "))
+        checkers = board[-1][len("Checkers:"):].split()
+        info = PositionInfo(fen=fen, legal_moves=legal_moves, checkers=checkers)
+
+        if len(self.__positions) >= max_cached_positions:
+            del self.__positions[next(iter(self.__positions))]
+        self.__positions[moves] = info
+        return info
+
+    async def __best_move(self, moves: tuple[str], movetime: int) -> SearchResult:
+        await self.__start()
+        if self.__ponder is not None:
+            ponder_moves, future = self.__ponder
+            if ponder_moves == moves:
+                self.__ponder = None
+                instrumentation.count("engine.ponder_hits")
+                self.__send("ponderhit")
+                return await future
+            await self.__stop_pondering(moves)
+        return await self.__go([self.__position(moves), f"go movetime {movetime}"])
+
+    async def __start_pondering(self, moves: tuple[str], movetime: int) -> None:
+        await self.__start()
+        await self.__stop_pondering()
+        future = self.__go([self.__position(moves), f"go ponder movetime {movetime}"])
+        self.__ponder = (moves, future)
+
+    # the stopped search result isn't waited, the next commands are queued after it anyway.
+    # moves are of the position needed instead, pondering has missed when the player's move isn't the expected one
+    async def __stop_pondering(self, moves: tuple[str] = None) -> None:
+        if self.__ponder is None:
+            return
+        ponder_moves, future = self.__ponder
+        # nobody awaits it, an exit error must not be reported as unretrieved
+        future.add_done_callback(lambda f: f.exception())
+        self.__ponder = None
+        if moves is not None and moves != ponder_moves:
+            instrumentation.count("engine.ponder_misses")
+        self.__send("stop")
+
+    def __go(self, lines: list[str]) -> asyncio.Future:
+        search = PendingSearch(self.__loop.create_future())
+        self.__searches.append(search)
+        for line in lines:
+            self.__send(line)
+        return search.future
+
+    async def __request(self, lines: list[str], terminator: str) -> list[str]:
+        reply = PendingReply(self.__loop.create_future(), terminator)
+        self.__replies.append(reply)
+        for line in lines:
+            self.__send(line)
+        return await reply.future
+
+    def __send(self, line: str) -> None:
+        self.__process.stdin.write((line + "\n").encode())
+
+    def __position(self, moves: tuple[str]) -> str:
+        return "position startpos" + (" moves " + " ".join(moves) if moves else "")
+
+    async def __read(self) -> None:
+        while True:
+            data = await self.__process.stdout.readline()
+            if not data:
+                break
+            self.__handle_line(data.decode().strip())
+
+        # the process has exited, nobody would answer the waiting calls
+        error = RuntimeError(f"Engine {self.path} has exited")
+        for pending in [*self.__searches, *self.__replies]:
+            if not pending.future.done():
+                pending.future.set_exception(error)
+        self.__searches.clear()
+        self.__replies.clear()
+        self.__ponder = None
+
+    def __handle_line(self, line: str) -> None:
+        if line.startswith("bestmove"):
+            if len(self.__searches) == 0:
+                return
+            search = self.__searches.popleft()
+            words = line.split()
+            best_move = words[1] if len(words) > 1 and words[1] != "(none)" else None
+            ponder_move = words[3] if len(words) > 3 and words[2] == "ponder" else None
+            lines = [search.lines[k] for k in sorted(search.lines)]
+            search.future.set_result(SearchResult(best_move, ponder_move, lines))
+        elif line.startswith("info"):
+            if len(self.__searches) != 0:
+                self.__parse_info(line, self.__searches[0])
+        elif len(self.__replies) != 0:
+            reply = self.__replies[0]
+            reply.lines.append(line)
+            if line.startswith(reply.terminator):
+                self.__replies.popleft()
+                reply.future.set_result(reply.lines)
+
+    def __parse_info(self, line: str, search: PendingSearch) -> None:
+        words = line.split()
+        if "pv" not in words or "score" not in words:
+            return
+        multipv = int(words[words.index("multipv") + 1]) if "multipv" in words else 1
+        i = words.index("score")
+        if words[i + 1] == "mate":
+            mate = int(words[i + 2])
+            score = mate_score - abs(mate) if mate > 0 else -mate_score + abs(mate)
+        else:
+            score = int(words[i + 2])
+        pv = words[words.index("pv") + 1:]
+        if len(pv) != 0:
+            search.lines[multipv] = (pv[0], score)
@@ -0,0 +1,218 @@
+import math
+import threading
+import time
+from dataclasses import replace
+from typing import Final
+
+import cv2
+import numpy as np
+from cv2.typing import MatLike
+
+from src.camera import FrameSource
+from src.cv.chessboard.chessboard import Chessboard, Position
+from src.cv.chessboard.chessboard_position_check import to_positions
+
+
+max_read_failures: Final[int] = 50
+
+# thumbnail width of the motion gate
+motion_thumbnail_width: Final[int] = 160
+# gray difference of the thumbnail pixel which is considered as a change
+min_motion_difference: Final[float] = 12
+# part of the changed thumbnail pixels which is considered as motion, a moved piece changes about 1% of the frame
+min_motion_part: Final[float] = 0.002
+# running background follows slow lighting changes while nothing moves
+background_rate: Final[float] = 0.05
+# frames without motion after which the burst is considered as settled
+settle_frames: Final[int] = 3
+# frames without any changes after which the gate is idle
+idle_frames: Final[int] = 30
+# seconds between the frames reads while the gate is idle
+idle_interval: Final[float] = 0.25
+
+# part of the voting frames which must agree on every cell, more than a half makes the vote unambiguous
+min_vote_part: Final[float] = 0.6
+position_values: Final[np.ndarray] = np.int8([p.value for p in Position])
+
+
+class FrameGrabber:
+    capture: FrameSource
+    # seconds to sleep after every read, frames are read as fast as the source gives them by default
+    interval: float
+
+    def __init__(self, capture: FrameSource):
+        self.capture = capture
+        self.interval = 0
+
+        self.__frame: MatLike = None
+        self.__frame_timestamp: float = None
+        self.__frame_id = 0
+        self.__running = False
+        self.__thread: threading.Thread = None
+        self.__condition = threading.Condition()
+
+    def start(self) -> 'FrameGrabber':
+        self.__running = True
+        self.__thread = threading.Thread(target=self.__run, name="frame-grabber", daemon=True)
+        self.__thread.start()
+        return self
+
+    def stop(self) -> None:
+        with self.__condition:
+            self.__running = False
+            self.__condition.notify_all()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+    def is_running(self) -> bool:
+        return self.__running
+
+    # returns the id, the newest frame which is newer than last_id and its time, frames in between are dropped
+    def read_latest(self, last_id: int = 0, timeout: float = 1.0) -> tuple[int, MatLike | None, float | None]:
+        with self.__condition:
+            self.__condition.wait_for(lambda: self.__frame_id > last_id or not self.__running, timeout)
+            if self.__frame_id <= last_id:
+                return last_id, None, None
+            return self.__frame_id, self.__frame, self.__frame_timestamp
+
+    def __run(self) -> None:
+        failures = 0
+        while self.__running:
+            ret, frame = self.capture.read()
+            if not ret:
+                failures += 1
+                if failures > max_read_failures:
+                    print("Exception: frame grabber can't read from capture")
+                    break
+                time.sleep(0.01)
+                continue
+            failures = 0
+            # the frame waits for the reader, so its time is taken now
+            timestamp = self.capture.timestamp if self.capture.timestamp is not None else time.time()
+
+            with self.__condition:
+                self.__frame = frame
+                self.__frame_timestamp = timestamp
+                self.__frame_id += 1
+                self.__condition.notify_all()
+            if self.interval > 0:
+                time.sleep(self.interval)
+
+        with self.__condition:
+            self.__running = False
+            self.__condition.notify_all()
+
+
+# Vote of the last window frames per cell, so a glared or blurred frame is outvoted by the others.
+# Frames where the board isn't found don't vote, occluded cells don't vote too
+class PositionVoter:
+    window: int
+    min_votes: int
+    # every cell has had enough votes on the last update, even when the board hasn't been emitted again
+    is_clear: bool
+
+    def __init__(self, window: int, min_votes: int = None):
+        self.window = window
+        self.min_votes = min_votes if min_votes is not None else math.ceil(window * min_vote_part)
+        if not 0 < self.min_votes <= window:
+            raise ValueError(f"Votes needed for a board ({self.min_votes}) must be in 1..{window}, the voting frames count")
+
+        # Position values of the last frames, -1 is no vote
+        self.__votes = np.full((window, 8, 8), -1, dtype=np.int8)
+        self.__count = 0
+        self.__emitted: np.ndarray = None
+        self.is_clear = False
+
+    # returns the chessboard with the voted cells once, when every cell has at least min_votes votes for one position,
+    # so the cells changed under a hand are accepted after they have been seen uncovered
+    def update(self, chessboard: Chessboard | None) -> Chessboard | None:
+        self.is_clear = False
+        if chessboard is None:
+            return None
+
+        votes = self.__votes[self.__count % self.window]
+        votes[:] = chessboard.cells
+        if chessboard.occluded is not None:
+            votes[chessboard.occluded] = -1
+        self.__count += 1
+        if self.__count < self.min_votes:
+            return None
+
+        counts = (self.__votes[..., None] == position_values).sum(axis=0)
+        if counts.max(axis=2).min() < self.min_votes:
+            return None
+        self.is_clear = True
+        cells = position_values[counts.argmax(axis=2)]
+
+        if self.__emitted is not None and np.array_equal(cells, self.__emitted):
+            return None
+        self.__emitted = cells
+        return replace(chessboard, cells=cells, positions=to_positions(cells))
+
+    # the votes are cleared, the last emitted board isn't emitted again until another board is voted
+    def reset(self) -> None:
+        self.__votes.fill(-1)
+        self.__count = 0
+        self.is_clear = False
+
+
+# Cheap stage in front of the detection. Frames are compared as small gray thumbnails, the detection is let
+# through after the motion has settled and only when the scene differs from the background, which is
+# the scene of the last detection. The gate is open for max_open_frames at most, or until it's closed
+class MotionGate:
+    max_open_frames: int
+    # nothing has changed for a while, so the frames may be polled less often
+    is_idle: bool
+
+    def __init__(self, max_open_frames: int):
+        self.max_open_frames = max_open_frames
+        self.is_idle = False
+
+        self.__background: np.ndarray = None
+        self.__previous: np.ndarray = None
+        self.__open_frames = 0
+        self.__still_frames = 0
+
+    # returns True when the frame should be detected
+    def update(self, frame: MatLike) -> bool:
+        thumbnail = self.__make_thumbnail(frame)
+        previous, self.__previous = self.__previous, thumbnail
+        if self.__background is None:
+            self.__background = thumbnail.copy()
+            self.__open_frames = self.max_open_frames
+        elif self.__is_changed(thumbnail, previous):
+            self.__open_frames = 0
+            self.__still_frames = 0
+            self.is_idle = False
+            return False
+        self.__still_frames += 1
+
+        if self.__open_frames == 0 and self.__still_frames >= settle_frames and self.__is_changed(thumbnail, self.__background):
+            self.__open_frames = self.max_open_frames
+        if self.__open_frames > 0:
+            self.__open_frames -= 1
+            if self.__open_frames == 0:
+                self.close()
+            return True
+
+        # a hand which has stopped for a moment isn't blended into the background, only the settled scene is
+        if self.__still_frames >= settle_frames and not self.__is_changed(thumbnail, self.__background):
+            cv2.accumulateWeighted(thumbnail, self.__background, background_rate)
+        self.is_idle = self.__still_frames >= idle_frames
+        return False
+
+    # the detection is done, the current scene is the background
+    def close(self) -> None:
+        self.__open_frames = 0
+        if self.__previous is not None:
+            self.__background = self.__previous.copy()
+
+    def __make_thumbnail(self, frame: MatLike) -> np.ndarray:
+        h, w = frame.shape[:2]
+        size = (motion_thumbnail_width, max(round(h * motion_thumbnail_width / w), 1))
+        thumbnail = cv2.cvtColor(cv2.resize(frame, size, interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+        return cv2.GaussianBlur(thumbnail, (3, 3), 0).astype(np.float32)
+
+    def __is_changed(self, thumbnail: np.ndarray, other: np.ndarray) -> bool:
+        return (np.abs(thumbnail - other) > min_motion_difference).mean() > min_motion_part
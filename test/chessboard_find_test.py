@@ -1,7 +1,10 @@
 from src.cv.chessboard_find import find_chessboard
+from src.cv.debug import WindowDebugSink, set_debug_sink
 import cv2
 from pathlib import Path
 
+set_debug_sink(WindowDebugSink())
+
 names = [
     "new_2.jpg",
     # "1.jpg",
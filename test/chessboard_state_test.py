@@ -0,0 +1,104 @@
+import numpy as np
+import pytest
+
+from src.cv.chessboard.chessboard import Position
+from src.step_processing.chessboard_state import create_from_fen, start_fen
+
+
+def play(fen: str, *moves: str) -> str:
+    state = create_from_fen(fen)
+    for move in moves:
+        state.apply_move(move)
+    return state.to_fen()
+
+
+def test_start_fen_round_trip():
+    assert create_from_fen(start_fen).to_fen() == start_fen
+
+
+@pytest.mark.parametrize("moves, fen", [
+    (("e2e4",), "rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq e3 0 1"),
+    (("e2e4", "c7c5", "g1f3"), "rnbqkbnr/pp1ppppp/8/2p5/4P3/5N2/PPPP1PPP/RNBQKB1R b KQkq - 1 2"),
+])
+def test_counters_and_en_passant_square(moves, fen):
+    assert play(start_fen, *moves) == fen
+
+
+@pytest.mark.parametrize("moves, fen", [
+    (("e1g1",), "r3k2r/8/8/8/8/8/8/R4RK1 b kq - 1 1"),
+    (("e1c1", "e8g8"), "r4rk1/8/8/8/8/8/8/2KR3R w - - 2 2"),
+    (("e1c1", "e8c8"), "2kr3r/8/8/8/8/8/8/2KR3R w - - 2 2"),
+])
+def test_castling(moves, fen):
+    assert play("r3k2r/8/8/8/8/8/8/R3K2R w KQkq - 0 1", *moves) == fen
+
+
+@pytest.mark.parametrize("move, fen", [
+    ("a1a8", "R3k2r/8/8/8/8/8/8/4K2R b Kk - 0 1"),
+    ("h1h2", "r3k2r/8/8/8/8/8/7R/R3K3 b Qkq - 1 1"),
+    ("e1e2", "r3k2r/8/8/8/8/8/4K3/R6R b kq - 1 1"),
+])
+def test_castling_rights_are_lost(move, fen):
+    assert play("r3k2r/8/8/8/8/8/8/R3K2R w KQkq - 0 1", move) == fen
+
+
+def test_en_passant_capture():
+    fen = play(start_fen, "e2e4", "a7a6", "e4e5", "d7d5")
+    assert fen == "rnbqkbnr/1pp1pppp/p7/3pP3/8/8/PPPP1PPP/RNBQKBNR w KQkq d6 0 3"
+    assert play(fen, "e5d6") == "rnbqkbnr/1pp1pppp/p2P4/8/8/8/PPPP1PPP/RNBQKBNR b KQkq - 0 3"
+
+
+@pytest.mark.parametrize("move, fen", [
+    ("a7a8q", "Qn6/8/8/8/8/8/8/k6K b - - 0 1"),
+    ("a7a8n", "Nn6/8/8/8/8/8/8/k6K b - - 0 1"),
+    ("a7b8r", "1R6/8/8/8/8/8/8/k6K b - - 0 1"),
+])
+def test_promotion(move, fen):
+    assert play("1n6/P7/8/8/8/8/8/k6K w - - 0 1", move) == fen
+
+
+def test_black_promotion():
+    assert play("k6K/8/8/8/8/8/p7/8 b - - 3 40", "a2a1q") == "k6K/8/8/8/8/8/8/q7 w - - 0 41"
+
+
+def test_occupancy():
+    occupancy = create_from_fen(start_fen).get_occupancy()
+    assert occupancy.dtype == np.int8
+    assert (occupancy[:2] == Position.WHITE.value).all()
+    assert (occupancy[2:6] == Position.EMPTY.value).all()
+    assert (occupancy[6:] == Position.BLACK.value).all()
+
+
+def perft(fen: str, depth: int) -> int:
+    if depth == 0:
+        return 1
+    return sum(perft(play(fen, move), depth - 1) for move in create_from_fen(fen).get_legal_moves())
+
+
+# node counts of the standard perft positions
+@pytest.mark.parametrize("fen, depth, nodes", [
+    (start_fen, 3, 8902),
+    ("r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1", 2, 2039),
+    ("8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1", 3, 2812),
+    ("rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8", 2, 1486),
+])
+def test_legal_moves_perft(fen, depth, nodes):
+    assert perft(fen, depth) == nodes
+
+
+def test_castling_through_attacked_square():
+    moves = create_from_fen("r3k2r/8/8/8/8/5r2/8/R3K2R w KQkq - 0 1").get_legal_moves()
+    assert "e1c1" in moves and "e1g1" not in moves
+    moves = create_from_fen("r3k2r/8/8/8/8/8/8/R3K2R w KQkq - 0 1").get_legal_moves()
+    assert "e1c1" in moves and "e1g1" in moves
+
+
+@pytest.mark.parametrize("fen, is_check, moves_count", [
+    ("rnb1kbnr/pppp1ppp/8/4p3/6Pq/5P2/PPPPP2P/RNBQKBNR w KQkq - 1 3", True, 0),
+    ("7k/5Q2/6K1/8/8/8/8/8 b - - 0 1", False, 0),
+    ("4k3/8/8/8/8/8/8/4K2r w - - 0 1", True, 3),
+])
+def test_mate_stalemate_and_check(fen, is_check, moves_count):
+    state = create_from_fen(fen)
+    assert state.is_check() == is_check
+    assert len(state.get_legal_moves()) == moves_count
@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+
+from src.cv.chessboard.chessboard import Position
+from src.step_processing.chessboard_state import create_from_fen, start_fen
+from src.step_processing.move_index import MoveIndex
+from src.step_processing.opening_book import OpeningBook, entry_dtype, polyglot_hash
+
+
+def state_after(fen: str, *moves: str):
+    state = create_from_fen(fen)
+    for move in moves:
+        state.apply_move(move)
+    return state
+
+
+# keys from the Polyglot book format description
+@pytest.mark.parametrize("moves, key", [
+    ((), 0x463b96181691fc9c),
+    (("e2e4",), 0x823c9b50fd114196),
+    (("e2e4", "d7d5"), 0x0756b94461c50fb0),
+    (("e2e4", "d7d5", "e4e5"), 0x662fafb965db29d4),
+    (("e2e4", "d7d5", "e4e5", "f7f5"), 0x22a48b5a8e47ff78),
+    (("e2e4", "d7d5", "e4e5", "f7f5", "e1e2"), 0x652a607ca3f242c1),
+    (("e2e4", "d7d5", "e4e5", "f7f5", "e1e2", "e8f7"), 0x00fdd303c946bdd9),
+    (("a2a4", "b7b5", "h2h4", "b5b4", "c2c4"), 0x3c8123ea7b067637),
+    (("a2a4", "b7b5", "h2h4", "b5b4", "c2c4", "b4c3", "a1a3"), 0x5c3f9b829b279560),
+])
+def test_polyglot_hash(moves, key):
+    assert polyglot_hash(state_after(start_fen, *moves)) == key
+
+
+def test_opening_book(tmp_path):
+    castling_state = create_from_fen("r3k2r/8/8/8/8/8/8/R3K2R w KQkq - 0 1")
+    # move fields are from row, from file, to row, to file, 3 bits each, the king takes the rook for castling
+    entries = np.array(sorted([
+        (polyglot_hash(create_from_fen(start_fen)), (1 << 9) | (4 << 6) | (3 << 3) | 4, 3, 0),
+        (polyglot_hash(create_from_fen(start_fen)), (0 << 9) | (6 << 6) | (2 << 3) | 5, 1, 0),
+        (polyglot_hash(castling_state), (0 << 9) | (4 << 6) | (0 << 3) | 7, 1, 0),
+    ]), dtype=entry_dtype)
+    path = tmp_path / "book.bin"
+    entries.tofile(path)
+
+    book = OpeningBook(str(path))
+    assert sorted(book.find_moves(create_from_fen(start_fen))) == [("e2e4", 3), ("g1f3", 1)]
+    assert book.find_moves(castling_state) == [("e1g1", 1)]
+    assert book.find_moves(state_after(start_fen, "e2e4")) == []
+    assert book.choose_move(create_from_fen(start_fen)) in ("e2e4", "g1f3")
+
+
+def test_move_index_finds_moves():
+    state = create_from_fen(start_fen)
+    index = MoveIndex(state, ["e2e3", "e2e4", "g1f3"])
+    for move in index.moves:
+        assert index.find_move(state_after(start_fen, move).get_occupancy()) == move
+
+
+def test_move_index_tolerates_one_wrong_cell():
+    state = create_from_fen(start_fen)
+    index = MoveIndex(state, ["e2e3", "e2e4", "g1f3"])
+    cells = state_after(start_fen, "e2e4").get_occupancy()
+    cells[4, 0] = Position.WHITE.value
+    assert index.find_move(cells) == "e2e4"
+
+
+def test_move_index_rejects_current_and_ambiguous_boards():
+    state = create_from_fen(start_fen)
+    index = MoveIndex(state, ["e2e3", "e2e4", "g1f3"])
+
+    # one misclassified cell of the current position isn't a move
+    cells = state.get_occupancy()
+    cells[4, 0] = Position.WHITE.value
+    assert index.find_move(cells) is None
+
+    # e2 emptied and both e3 and e4 taken is one cell away from both pawn moves
+    cells = state_after(start_fen, "e2e4").get_occupancy()
+    cells[2, 4] = Position.WHITE.value
+    assert index.find_move(cells) is None
+
+
+def test_move_index_castling_and_promotion():
+    state = create_from_fen("r3k2r/P7/8/8/8/8/8/R3K2R w KQkq - 0 1")
+    index = MoveIndex(state, ["e1g1", "e1c1", "a7a8q", "a7a8n", "a7a8r", "a7a8b"])
+    assert index.moves == ["e1g1", "e1c1", "a7a8q"]
+    assert index.find_move(state_after("r3k2r/P7/8/8/8/8/8/R3K2R w KQkq - 0 1", "e1g1").get_occupancy()) == "e1g1"
+    assert index.find_move(state_after("r3k2r/P7/8/8/8/8/8/R3K2R w KQkq - 0 1", "e1c1").get_occupancy()) == "e1c1"